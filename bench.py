@@ -0,0 +1,307 @@
+# bench.py
+"""Offline load test for the bot handlers.
+
+Replays synthetic (or recorded) update streams through start/handle_message
+with stub Update/Context objects, so no token or network is needed, and
+reports throughput plus p50/p95/p99 latency per handler for every scale.
+
+    python bench.py --chats 1,10,50 --parties 1,3 --expenses 10,100
+    python bench.py --replay updates.jsonl
+    python bench.py --storage sqlite --out bench_output.txt
+    python bench.py --settle 4,8,12,14,16,18
+    python bench.py --chats 1 --expenses 5000 --members 40 --weighted 0.5
+
+--replay takes one JSON object per line: {"chat": id, "user": id, "text": "..."}
+(optionally "username"). --out appends one JSON line per scale, so results
+can be compared across commits. --weighted types that fraction of the
+synthetic expenses with a split (every fifth of them an itemized bill).
+--settle times the settlement solver alone: exact search against greedy
+pairing per group size, the transfers each finds, and how often the exact
+path gave up (over SETTLE_MAX_EXACT members or past SETTLE_BUDGET_MS).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import random
+import argparse
+import tempfile
+import importlib
+import subprocess
+from types import SimpleNamespace
+from datetime import datetime
+
+# ---------------- stubs ----------------
+class FakeBot:
+    # what the outbox sends through
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self.sent += 1
+
+    async def send_document(self, chat_id, document, caption=None, reply_markup=None, **kwargs):
+        self.sent += 1
+
+def fake_update(chat_id, user_id, text, username=None):
+    message = SimpleNamespace(text=text, message_thread_id=None, is_topic_message=False)
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_user=SimpleNamespace(id=user_id, username=username or f"user{user_id}", first_name="User"),
+        message=message,
+        effective_message=message,
+    )
+
+# ---------------- streams ----------------
+def bill(e, members):
+    # a weighted split over every other member, or a two-item bill
+    amount = f"{(e * 37) % 500 + 1}.{e % 100:02d}"
+    names = " ".join(f"user{1 + (e + j) % members}{':2' if j == 0 else ''}" for j in range(0, members, 2))
+    if e % 5:
+        return f"{amount} {names}"
+    return f"{amount} {names}\n{e % 50 + 1}.50 user{1 + e % members}"
+
+def synthetic(bot, chats, parties, expenses, members=4, weighted=0.0):
+    """Yield (chat, user, text): every chat creates parties, adds members and
+    expenses, then asks for summaries and exports."""
+    t = bot.TEXT["en"]
+    btn = t["buttons"]
+    for c in range(chats):
+        chat = -1000 - c
+        yield chat, 1, "/start"
+        yield chat, 1, bot.LANG_LABELS["en"]
+        for p in range(parties):
+            yield chat, 1, btn[0][0]
+            yield chat, 1, f"party{p}"
+            for mb in range(2, members + 1):
+                yield chat, 1, btn[2][0]
+                yield chat, 1, t["add_member_btn"]
+                yield chat, 1, f"user{mb}"
+        for p in range(parties):
+            yield chat, 1, btn[0][1]
+            yield chat, 1, f"party{p}"
+            for e in range(expenses):
+                user = 1 + e % members
+                yield chat, user, btn[1][0]
+                if (e * 61) % 100 < weighted * 100:
+                    yield chat, user, bill(e, members)
+                else:
+                    yield chat, user, f"{(e * 37) % 500 + 1}.{e % 100:02d}"
+                yield chat, user, f"item {e}" if e % 3 else "-"
+            yield chat, 1, btn[1][1]
+            yield chat, 1, btn[3][0]
+            yield chat, 1, btn[3][0]  # second press hits the render cache
+            for label in bot.EXPORT_LABELS:
+                yield chat, 1, btn[3][1]
+                yield chat, 1, label
+
+def recorded(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                u = json.loads(line)
+                yield u["chat"], u["user"], u["text"], u.get("username")
+
+# ---------------- run ----------------
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[i]
+
+def classify(bot, text, user_data):
+    # same lookup handle_message does, so results are grouped per handler
+    if text == "/start":
+        return "start"
+    state = user_data.get("state", bot.State.MENU)
+    action = bot.BUTTONS.get(text) or bot.STATE_BUTTONS.get(state, {}).get(text) or bot.STATE_INPUT.get(state)
+    return action.__name__ if action else "fallback"
+
+async def replay(bot, stream):
+    timings = {}
+    user_data = {}
+    start_handler = bot.per_chat(bot.start)
+    message_handler = bot.per_chat(bot.handle_message)
+    fake = FakeBot()
+    await bot.OUTBOX.start(SimpleNamespace(bot=fake))
+    n = 0
+    began = time.perf_counter()
+    for item in stream:
+        chat, user, text = item[:3]
+        username = item[3] if len(item) > 3 else None
+        ctx = SimpleNamespace(user_data=user_data.setdefault((chat, user), {}), chat_data={}, bot_data={})
+        name = classify(bot, text, ctx.user_data)
+        handler = start_handler if text == "/start" else message_handler
+        t0 = time.perf_counter()
+        await handler(fake_update(chat, user, text, username), ctx)
+        timings.setdefault(name, []).append(time.perf_counter() - t0)
+        n += 1
+    # handlers only queue their replies; count the time to send them too
+    await bot.OUTBOX.stop()
+    return n, time.perf_counter() - began, fake.sent, timings
+
+def settlement_timings(bot, chats, rounds=50):
+    # recompute from the ledger state, as after a membership change
+    out = []
+    for cid in chats:
+        for party in bot.STORE.chat(cid).parties.values():
+            for _ in range(rounds):
+                party._settled = None
+                party._sets = None
+                t0 = time.perf_counter()
+                party.settlements()
+                out.append(time.perf_counter() - t0)
+    return out
+
+# ---------------- settlement solver ----------------
+def balance_vector(rng, n):
+    # round amounts, and plenty of members who paid nothing, like real parties
+    paid = [0 if rng.random() < 0.4 else rng.randrange(1, 20) * 500 for _ in range(n)]
+    q, r = divmod(sum(paid), n)
+    return tuple(sorted(b for b in (p - q - (i < r) for i, p in enumerate(paid)) if b))
+
+def settle_scale(n, rounds, rng):
+    import settlement
+    from metrics import METRICS
+    def gave_up(reason):
+        return METRICS.counters[("bot_settle_greedy_total", (("reason", reason),))]
+    size0, time0 = gave_up("size"), gave_up("time")
+    exact, greedy = [], []
+    exact_n = greedy_n = 0
+    for _ in range(rounds):
+        values = balance_vector(rng, n)
+        t0 = time.perf_counter()
+        exact_n += len(settlement.min_transfers.__wrapped__(values))  # past the cache
+        exact.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        greedy_n += len(settlement.settle_group(range(len(values)), values))
+        greedy.append(time.perf_counter() - t0)
+    exact.sort()
+    greedy.sort()
+    return {
+        "members": n,
+        "rounds": rounds,
+        "exact_p50_ms": percentile(exact, 50) * 1000,
+        "exact_p95_ms": percentile(exact, 95) * 1000,
+        "greedy_p50_ms": percentile(greedy, 50) * 1000,
+        "transfers_exact": exact_n / rounds,
+        "transfers_greedy": greedy_n / rounds,
+        "gave_up_size": gave_up("size") - size0,
+        "gave_up_time": gave_up("time") - time0,
+    }
+
+def report_settle(rows):
+    print(f"{'members':>8}{'exact p50':>11}{'exact p95':>11}{'greedy p50':>12}{'transfers':>11}{'greedy':>8}{'gave up':>9}")
+    for r in rows:
+        print(f"{r['members']:>8}{r['exact_p50_ms']:>11.3f}{r['exact_p95_ms']:>11.3f}{r['greedy_p50_ms']:>12.3f}"
+              f"{r['transfers_exact']:>11.2f}{r['transfers_greedy']:>8.2f}{r['gave_up_size'] + r['gave_up_time']:>9}")
+
+def load_bot(workdir, storage):
+    # main reads its data files from the working directory at import time
+    os.chdir(workdir)
+    os.environ["STORAGE"] = storage
+    if "main" in sys.modules:
+        return importlib.reload(sys.modules["main"])
+    return importlib.import_module("main")
+
+def run_scale(storage, stream_factory, label):
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = load_bot(workdir, storage)
+        try:
+            n, elapsed, sent, timings = asyncio.run(replay(bot, stream_factory(bot)))
+            t0 = time.perf_counter()
+            bot.STORE.flush()
+            flush = time.perf_counter() - t0
+            timings["settlements"] = settlement_timings(bot, list(bot.STORE.loaded()))
+        finally:
+            bot.STORE.close()
+    rows = {}
+    for name, values in timings.items():
+        values.sort()
+        rows[name] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+    return {
+        "scale": label,
+        "storage": storage,
+        "updates": n,
+        "messages_sent": sent,
+        "seconds": elapsed,
+        "updates_per_s": n / elapsed if elapsed else 0.0,
+        "final_flush_ms": flush * 1000,
+        "actions": rows,
+    }
+
+def report(result):
+    print(f"\n== {result['scale']} [{result['storage']}]: {result['updates']} updates in "
+          f"{result['seconds']:.2f}s ({result['updates_per_s']:.0f}/s), {result['messages_sent']} messages sent, "
+          f"final flush {result['final_flush_ms']:.1f} ms")
+    print(f"{'action':<22}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, r in sorted(result["actions"].items()):
+        print(f"{name:<22}{r['count']:>8}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}{r['p99_ms']:>10.3f}")
+
+def git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def ints(text):
+    return [int(x) for x in text.split(",") if x]
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay update streams through the handlers and time them.")
+    ap.add_argument("--chats", type=ints, default=[1, 10, 50])
+    ap.add_argument("--parties", type=ints, default=[1, 3])
+    ap.add_argument("--expenses", type=ints, default=[10, 100])
+    ap.add_argument("--members", type=int, default=4)
+    ap.add_argument("--weighted", type=float, default=0.0, help="fraction of synthetic expenses with a split")
+    ap.add_argument("--replay", help="JSON-lines file of recorded updates instead of synthetic ones")
+    ap.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    ap.add_argument("--out", help="append results as JSON lines to this file")
+    ap.add_argument("--settle", type=ints, help="only time the settlement solver, for these group sizes")
+    ap.add_argument("--rounds", type=int, default=50, help="balance vectors per group size for --settle")
+    args = ap.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault("PERSIST_LAG", "0.05")
+    # no flood limits offline, so the outbox drains as fast as it can
+    for name in ("OUTBOX_CHAT_RATE", "OUTBOX_GROUP_RATE", "OUTBOX_GLOBAL_RATE"):
+        os.environ.setdefault(name, "0")
+    out = os.path.abspath(args.out) if args.out else None
+    if args.replay:
+        path = os.path.abspath(args.replay)
+        scales = [(f"replay {os.path.basename(path)}", lambda bot: recorded(path))]
+    else:
+        scales = [
+            (f"chats={c} parties={p} expenses={e}",
+             lambda bot, c=c, p=p, e=e: synthetic(bot, c, p, e, args.members, args.weighted))
+            for c in args.chats for p in args.parties for e in args.expenses
+        ]
+    meta = {"rev": git_rev(), "at": datetime.utcnow().isoformat()}
+    if args.settle:
+        # main applies SETTLE_MAX_EXACT / SETTLE_BUDGET_MS
+        with tempfile.TemporaryDirectory() as workdir:
+            load_bot(workdir, args.storage).STORE.close()
+        rng = random.Random(0)
+        rows = [settle_scale(n, args.rounds, rng) for n in args.settle]
+        report_settle(rows)
+        if out:
+            with open(out, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps({**meta, "settle": row}) + "\n")
+        return
+    for label, factory in scales:
+        result = run_scale(args.storage, factory, label)
+        report(result)
+        if out:
+            with open(out, "a", encoding="utf-8") as f:
+                f.write(json.dumps({**meta, **result}) + "\n")
+
+if __name__ == "__main__":
+    main()
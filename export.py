@@ -0,0 +1,95 @@
+# export.py
+import csv
+import json
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+
+from party import from_cents, money, split_text
+
+# Reports are generated line by line into a SpooledTemporaryFile: small ones
+# stay in memory, big ones roll over to disk instead of being built as one
+# string. generate() does blocking work, so run it in an executor.
+SPOOL_MAX = 1024 * 1024
+
+# ---------------- TXT ----------------
+def txt_lines(name, party):
+    avg, balances, debts = party.settlements()
+    yield f"Party: {name}\n"
+    yield f"Creator ID: {party.creator}\n"
+    yield f"Generated: {datetime.utcnow().isoformat()} UTC\n"
+    yield "\n"
+    yield "Members and totals:\n"
+    for u,tot in party.members.items():
+        yield f" - {u}: {money(tot)}\n"
+    yield "\n"
+    yield f"Total: {money(party.total)}\n"
+    yield f"Average: {money(avg)}\n"
+    yield "\n"
+    yield "Balances (positive => should receive):\n"
+    for u,b in balances.items():
+        yield f" - {u}: {money(b, signed=True)}\n"
+    yield "\n"
+    yield "Suggested transfers:\n"
+    if debts:
+        for d,c,a in debts:
+            yield f" - {d} -> {c} : {money(a)}\n"
+    else:
+        yield " - All settled\n"
+    yield "\n"
+    yield "Expenses:\n"
+    ex = party.expenses
+    for i in range(len(ex)):
+        desc = ex.desc(i)
+        split = ex.split(i)
+        yield (f" - {ex.ts(i) or '-'} {ex.user(i)}: {money(ex.cents[i])}{' — ' + desc if desc else ''}"
+               f"{' [' + split_text(split) + ']' if split else ''}\n")
+
+# ---------------- CSV ----------------
+class _Lines:
+    # csv.writer needs something with write(); hand each row straight back
+    def write(self, line):
+        return line
+
+def csv_lines(name, party):
+    writer = csv.writer(_Lines())
+    yield writer.writerow(["user", "amount", "desc", "ts", "split"])
+    ex = party.expenses
+    for i in range(len(ex)):
+        split = ex.split(i)
+        yield writer.writerow([ex.user(i), money(ex.cents[i]), ex.desc(i) or "", ex.ts(i) or "",
+                               split_text(split) if split else ""])
+
+# ---------------- JSON lines ----------------
+def jsonl_lines(name, party):
+    avg, balances, debts = party.settlements()
+    head = {
+        "type": "party",
+        "party": name,
+        "creator": party.creator,
+        "generated": datetime.utcnow().isoformat(),
+        "total": from_cents(party.total),
+        "average": from_cents(avg),
+        "members": {u: from_cents(c) for u, c in party.members.items()},
+        "balances": {u: from_cents(b) for u, b in balances.items()},
+    }
+    yield json.dumps(head, ensure_ascii=False) + "\n"
+    for d, c, a in debts:
+        yield json.dumps({"type": "transfer", "from": d, "to": c, "amount": from_cents(a)}, ensure_ascii=False) + "\n"
+    for e in party.expenses:
+        yield json.dumps({"type": "expense", **e}, ensure_ascii=False) + "\n"
+
+# format -> (line generator, file extension)
+FORMATS = {
+    "txt": (txt_lines, "txt"),
+    "csv": (csv_lines, "csv"),
+    "json": (jsonl_lines, "jsonl"),
+}
+
+def generate(name, party, fmt):
+    """Write the report into a spooled file; returns (file rewound to 0, filename)."""
+    lines, ext = FORMATS[fmt]
+    f = SpooledTemporaryFile(max_size=SPOOL_MAX, mode="w+b")
+    for line in lines(name, party):
+        f.write(line.encode("utf-8"))
+    f.seek(0)
+    return f, f"{name}_summary.{ext}"
@@ -0,0 +1,289 @@
+# fake_telegram.py
+"""End-to-end check of webhook mode against a local stand-in for the Bot API.
+
+Starts a fake Bot API server, runs main.py against it in webhook mode from a
+temporary directory, then posts updates to the webhook the way Telegram does
+and waits for each one's reply. Reports latency from post to first reply,
+checks the health endpoint and secret token, and exits non-zero if any
+update went unanswered.
+
+    python fake_telegram.py
+    python fake_telegram.py --chats 20 --expenses 50 --storage sqlite
+    python fake_telegram.py --shards 4
+    python fake_telegram.py --flood 0.1
+    python fake_telegram.py --replay updates.jsonl
+
+--replay takes the same JSON-lines format as bench.py.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import secrets
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from urllib.parse import parse_qs
+from email.parser import BytesParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bench
+
+TOKEN = "123456:fake"
+
+# ---------------- fake Bot API ----------------
+class FakeBotApi:
+    """Answers the Bot API methods the bot uses and records what it sends.
+
+    With ``flood`` > 0 that share of sends is refused with a 429 the way
+    Telegram does, to exercise the bot's retries.
+    """
+
+    def __init__(self, flood=0.0):
+        self.flood = flood
+        self.refused = 0
+        self.webhook = None  # (url, secret) once setWebhook was called
+        self.replies = {}  # chat_id -> [(time, method, text)]
+        self._cond = threading.Condition()
+        self._ids = iter(range(1, 1 << 62))
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                method = self.path.rsplit("/", 1)[-1]
+                if method.startswith("send") and random.random() < api.flood:
+                    api.refused += 1
+                    status, reply = 429, {"ok": False, "error_code": 429, "parameters": {"retry_after": 1},
+                                          "description": "Too Many Requests: retry after 1"}
+                else:
+                    result = api.call(method, api.params(self.headers.get("Content-Type", ""), body))
+                    status, reply = 200, {"ok": True, "result": result}
+                payload = json.dumps(reply).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/bot"
+        threading.Thread(target=self.server.serve_forever, name="fake-api", daemon=True).start()
+
+    def params(self, content_type, body):
+        if content_type.startswith("multipart/"):
+            msg = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            return {part.get_param("name", header="content-disposition"): part.get_payload(decode=True).decode("utf-8", "replace")
+                    for part in msg.get_payload() if not part.get_filename()}
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()}
+
+    def call(self, method, params):
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method == "setWebhook":
+            with self._cond:
+                self.webhook = (params.get("url"), params.get("secret_token"))
+                self._cond.notify_all()
+            return True
+        if method in ("sendMessage", "sendDocument"):
+            chat_id = int(params["chat_id"])
+            message = {"message_id": next(self._ids), "date": int(time.time()),
+                       "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"}}
+            if method == "sendMessage":
+                message["text"] = params.get("text", "")
+            else:
+                message["document"] = {"file_id": "doc", "file_unique_id": "doc"}
+            with self._cond:
+                self.replies.setdefault(chat_id, []).append((time.perf_counter(), method, message.get("text")))
+                self._cond.notify_all()
+            return message
+        return True
+
+    def wait(self, predicate, timeout):
+        with self._cond:
+            return self._cond.wait_for(predicate, timeout)
+
+    def reply_count(self, chat_id):
+        return len(self.replies.get(chat_id, ()))
+
+    def close(self):
+        self.server.shutdown()
+
+# ---------------- webhook client ----------------
+def make_update(update_id, chat, user, text, username=None):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat, "type": "group" if chat < 0 else "private"},
+        "from": {"id": user, "is_bot": False, "first_name": "User", "username": username or f"user{user}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def post(url, body, secret):
+    req = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"), method="POST",
+                                 headers={"Content-Type": "application/json"})
+    if secret is not None:
+        req.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    try:
+        with urllib.request.urlopen(req, timeout=30) as r:
+            return r.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as r:
+            return r.status, json.loads(r.read())
+    except urllib.error.HTTPError as e:
+        return e.code, None
+    except OSError:
+        return None, None
+
+def drive_chat(api, url, secret, updates, timeout):
+    # like a user: send the next message once the bot answered the last one
+    latencies, missing, refused = [], 0, 0
+    for update_id, (chat, user, text, username) in updates:
+        seen = api.reply_count(chat)
+        t0 = time.perf_counter()
+        status = post(url, make_update(update_id, chat, user, text, username), secret)
+        while status == 503:
+            refused += 1
+            time.sleep(0.05)
+            status = post(url, make_update(update_id, chat, user, text, username), secret)
+        if status != 200 or not api.wait(lambda: api.reply_count(chat) > seen, timeout):
+            missing += 1
+            continue
+        latencies.append(api.replies[chat][seen][0] - t0)
+    return latencies, missing, refused
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# ---------------- run ----------------
+def run(args, items):
+    api = FakeBotApi(args.flood)
+    port = free_port()
+    secret = secrets.token_hex(16)
+    url = f"http://127.0.0.1:{port}/telegram"
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, BOT_TOKEN=TOKEN, TELEGRAM_API_URL=api.url, STORAGE=args.storage,
+               WEBHOOK_URL=url, WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(port), WEBHOOK_SECRET=secret,
+               UPDATE_QUEUE_SIZE=str(args.queue), SHARDS=str(args.shards), PERSIST_LAG="0.05")
+    # the fake API has no flood limits of its own; leave the outbox unthrottled unless asked
+    for name in ("OUTBOX_CHAT_RATE", "OUTBOX_GROUP_RATE", "OUTBOX_GLOBAL_RATE"):
+        env.setdefault(name, "0")
+    failures = []
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = subprocess.Popen([sys.executable, os.path.join(here, "main.py")], cwd=workdir, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        try:
+            if not api.wait(lambda: api.webhook is not None, args.timeout):
+                failures.append("bot never called setWebhook")
+            elif api.webhook != (url, secret):
+                failures.append(f"setWebhook got {api.webhook}")
+            deadline = time.monotonic() + args.timeout
+            while get(url.rsplit("/", 1)[0] + "/healthz")[0] != 200 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            status, health = get(url.rsplit("/", 1)[0] + "/healthz")
+            if status != 200:
+                failures.append(f"health check returned {status}")
+            if post(url, make_update(0, -1, 1, "/start"), "wrong") != 403:
+                failures.append("wrong secret token was accepted")
+
+            chats = {}
+            for update_id, item in enumerate(items, 1):
+                chats.setdefault(item[0], []).append((update_id, item))
+            began = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.connections) as pool:
+                results = list(pool.map(lambda u: drive_chat(api, url, secret, u, args.timeout), chats.values()))
+            elapsed = time.perf_counter() - began
+        finally:
+            bot.terminate()
+            try:
+                output = bot.communicate(timeout=args.timeout)[0]
+            except subprocess.TimeoutExpired:
+                bot.kill()
+                output = bot.communicate()[0]
+            api.close()
+    latencies = sorted(x for r in results for x in r[0])
+    missing = sum(r[1] for r in results)
+    if missing:
+        failures.append(f"{missing} updates got no reply")
+    if bot.returncode != 0:
+        failures.append(f"bot exited with {bot.returncode}")
+    return {
+        "updates": len(items),
+        "seconds": elapsed,
+        "updates_per_s": len(items) / elapsed if elapsed else 0.0,
+        "p50_ms": bench.percentile(latencies, 50) * 1000,
+        "p95_ms": bench.percentile(latencies, 95) * 1000,
+        "p99_ms": bench.percentile(latencies, 99) * 1000,
+        "refused_503": sum(r[2] for r in results),
+        "refused_429": api.refused,
+        "failures": failures,
+    }, output
+
+def main():
+    ap = argparse.ArgumentParser(description="Run the bot in webhook mode against a fake Bot API.")
+    ap.add_argument("--chats", type=int, default=5)
+    ap.add_argument("--parties", type=int, default=1)
+    ap.add_argument("--expenses", type=int, default=10)
+    ap.add_argument("--members", type=int, default=3)
+    ap.add_argument("--replay", help="JSON-lines file of recorded updates instead of synthetic ones")
+    ap.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    ap.add_argument("--connections", type=int, default=40, help="chats posting at the same time")
+    ap.add_argument("--queue", type=int, default=1000, help="UPDATE_QUEUE_SIZE for the bot")
+    ap.add_argument("--shards", type=int, default=1, help="SHARDS: worker processes behind the front")
+    ap.add_argument("--flood", type=float, default=0.0, help="share of sends the fake API answers with 429")
+    ap.add_argument("--timeout", type=float, default=20.0)
+    ap.add_argument("--out", help="append the result as a JSON line to this file")
+    args = ap.parse_args()
+
+    if args.replay:
+        items = list(bench.recorded(args.replay))
+    else:
+        # the synthetic stream needs the bot's button labels
+        with tempfile.TemporaryDirectory() as scratch:
+            cwd = os.getcwd()
+            texts = bench.load_bot(scratch, "json")
+            try:
+                items = [(c, u, t, None) for c, u, t in
+                         bench.synthetic(texts, args.chats, args.parties, args.expenses, args.members)]
+            finally:
+                texts.STORE.close()
+                os.chdir(cwd)
+    result, output = run(args, items)
+    print(f"{result['updates']} updates in {result['seconds']:.2f}s ({result['updates_per_s']:.0f}/s), "
+          f"reply latency p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms, "
+          f"p99 {result['p99_ms']:.1f} ms, {result['refused_503']} refused with 503, "
+          f"{result['refused_429']} sends refused with 429")
+    if args.out:
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"rev": bench.git_rev(), **result}) + "\n")
+    if result["failures"]:
+        print("FAILED:\n - " + "\n - ".join(result["failures"]))
+        print("--- bot output ---\n" + output)
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 # main.py
 import os
-import json
-import io
+import asyncio
+import functools
+import weakref
+from contextlib import nullcontext
+from collections import OrderedDict
+from enum import Enum
 from datetime import datetime
 from telegram import (
     Update,
@@ -14,23 +18,64 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     ContextTypes,
-    filters
+    filters,
+    TypeHandler
 )
+from telegram.request import HTTPXRequest
+from storage import JsonStore, SqliteStore
+from party import money, parse_bill, split_to_ops
+import export
+import settlement
+from metrics import METRICS, SlowUpdateProfiler, serve
+from webhook import WebhookServer, run_webhook
+from shards import ShardRouter, rebalance, run_worker, shard_path
+from outbox import Outbox
+from persistence import StorePersistence
 
 DATA_FILE = "data.json"
+DB_FILE = os.environ.get("DB_FILE", "data.db")
+STORAGE = os.environ.get("STORAGE", "json")
+
+# ---------------- shards ----------------
+# SHARDS=N (N > 1) makes this process a front that routes every update by chat
+# id to one of N worker processes. Worker i runs with SHARD_INDEX=i and owns
+# the chats that hash to it, in its own data files (data.iofN.json, ...).
+# Starting with a different N moves the chats to the new files first.
+SHARDS = int(os.environ.get("SHARDS", "1"))
+SHARD_INDEX = int(os.environ["SHARD_INDEX"]) if os.environ.get("SHARD_INDEX") else None
+IS_FRONT = SHARDS > 1 and SHARD_INDEX is None
 
 # ---------------- load/save ----------------
+# STORAGE=sqlite loads chats from DB_FILE on demand (import the JSON files once
+# with `python storage.py data.db data.json parties_data.json`); the default
+# keeps everything in memory with data.json + journal.
+# PERSIST_LAG: how many seconds of changes we accept to lose on a crash
+if STORAGE == "sqlite":
+    STORE = SqliteStore(
+        shard_path(DB_FILE, SHARD_INDEX or 0, SHARDS),
+        max_lag=float(os.environ.get("PERSIST_LAG", "1.0")),
+        cache_size=int(os.environ.get("CHAT_CACHE_SIZE", "256")),
+    )
+else:
+    STORE = JsonStore(
+        shard_path(DATA_FILE, SHARD_INDEX or 0, SHARDS),
+        max_lag=float(os.environ.get("PERSIST_LAG", "1.0")),
+        compact_every=int(os.environ.get("COMPACT_EVERY", "1000")),
+    )
+
 def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+    if SHARD_INDEX is None:
+        rebalance(STORAGE, DB_FILE if STORAGE == "sqlite" else DATA_FILE, SHARDS)
+    if not IS_FRONT:
+        # the front holds no chats
+        STORE.load()
 
-def save_data(d):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(d, f, ensure_ascii=False, indent=2)
+def save_data(chat_id, op, **fields):
+    # apply one change to the chat; the disk write happens on the writer thread
+    with METRICS.timed("bot_save_seconds"):
+        STORE.commit({"op": op, "chat": str(chat_id), **fields})
 
-DATA = load_data()
+load_data()
 
 # ---------------- localization ----------------
 TEXT = {
@@ -42,7 +87,7 @@ TEXT = {
             ["🎉 Створити вечірку", "🎈 Обрати вечірку"],
             ["➕ Додати витрату", "👥 Учасники"],
             ["✏️ Редагувати учасників", "🗑️ Керування вечірками"],
-            ["📊 Підсумок", "📤 Експорт у TXT"],
+            ["📊 Підсумок", "📤 Експорт"],
             ["🌐 Мова"]
         ],
         "ask_party_name": "Введіть назву нової вечірки:",
@@ -50,9 +95,11 @@ TEXT = {
         "no_parties": "Поки що немає вечірок.",
         "choose_party_prompt": "Оберіть вечірку зі списку:",
         "party_selected": "✅ Вибрано вечірку: {name}",
-        "ask_amount": "💰 Введіть суму витрати (наприклад: 25.50):",
+        "ask_amount": "💰 Введіть суму витрати (наприклад: 25.50).\n"
+                      "Якщо платять не всі порівну — додайте імена з вагою: 25.50 ann bob:2\n"
+                      "Чек по позиціях — кожна з нового рядка: 12.50 ann bob",
         "ask_desc": "📝 Введіть опис витрати (або '-' для пропуску):",
-        "expense_added": "✅ Додано витрату {amount:.2f} від {user}",
+        "expense_added": "✅ Додано витрату {amount} від {user}",
         "invalid_amount": "❗ Некоректна сума. Спробуйте ще раз.",
         "no_current_party": "❗ Спочатку оберіть вечірку.",
         "members_none": "Поки що немає учасників.",
@@ -66,11 +113,25 @@ TEXT = {
         "no_permission_delete": "⛔ Лише автор вечірки може її видалити.",
         "party_deleted": "🗑️ Вечірку '{name}' видалено.",
         "export_no_party": "❗ Спочатку оберіть вечірку.",
+        "export_format": "Оберіть формат файлу:",
         "export_generating": "📤 Генерую підсумок і надсилаю файл...",
         "export_done": "✅ Файл надіслано.",
         "summary_header": "📊 Підсумок вечірки:",
         "all_settled": "✅ Усі розрахувалися.",
         "change_lang_prompt": "Оберіть мову:",
+        "member_not_found": "❗ Учасника не знайдено.",
+        "split_unknown": "❗ Таких учасників немає у вечірці: {names}",
+        "party_not_found": "❌ Такої вечірки немає.",
+        "add_member_btn": "➕ Додати учасника",
+        "remove_member_btn": "🗑️ Видалити учасника",
+        "back_btn": "↩️ Назад",
+        "spent_header": "💸 Витрати за {period}:",
+        "spent_none": "За {period} витрат немає.",
+        "history_header": "🧾 Витрати {name} по місяцях:",
+        "history_none": "У {name} ще немає витрат.",
+        "all_time": "весь час",
+        "total": "Разом",
+        "invalid_period": "❗ Вкажіть місяць як 2024-05 або all.",
     },
     "en": {
         "welcome": "Hi! I’m a party expenses bot 🎉",
@@ -80,7 +141,7 @@ TEXT = {
             ["🎉 Create party", "🎈 Select party"],
             ["➕ Add expense", "👥 Members"],
             ["✏️ Edit members", "🗑️ Manage parties"],
-            ["📊 Summary", "📤 Export to TXT"],
+            ["📊 Summary", "📤 Export"],
             ["🌐 Language"]
         ],
         "ask_party_name": "Enter new party name:",
@@ -88,9 +149,11 @@ TEXT = {
         "no_parties": "No parties yet.",
         "choose_party_prompt": "Choose a party from the list:",
         "party_selected": "✅ Selected party: {name}",
-        "ask_amount": "💰 Enter amount (e.g. 25.50):",
+        "ask_amount": "💰 Enter amount (e.g. 25.50).\n"
+                      "To split it unevenly, add names with weights: 25.50 ann bob:2\n"
+                      "For an itemized bill, one item per line: 12.50 ann bob",
         "ask_desc": "📝 Enter description (or '-' to skip):",
-        "expense_added": "✅ Added expense {amount:.2f} from {user}",
+        "expense_added": "✅ Added expense {amount} from {user}",
         "invalid_amount": "❗ Invalid amount. Try again.",
         "no_current_party": "❗ Please select a party first.",
         "members_none": "No members yet.",
@@ -104,373 +167,647 @@ TEXT = {
         "no_permission_delete": "⛔ Only party creator can delete it.",
         "party_deleted": "🗑️ Party '{name}' deleted.",
         "export_no_party": "❗ Please select a party first.",
+        "export_format": "Choose file format:",
         "export_generating": "📤 Generating summary and sending file...",
         "export_done": "✅ File sent.",
         "summary_header": "📊 Party summary:",
         "all_settled": "✅ All settled.",
         "change_lang_prompt": "Choose language:",
+        "member_not_found": "❗ Member not found.",
+        "split_unknown": "❗ Not members of this party: {names}",
+        "party_not_found": "❌ No such party.",
+        "add_member_btn": "➕ Add member",
+        "remove_member_btn": "🗑️ Remove member",
+        "back_btn": "↩️ Back",
+        "spent_header": "💸 Spending for {period}:",
+        "spent_none": "No expenses for {period}.",
+        "history_header": "🧾 Spending by {name}, by month:",
+        "history_none": "{name} has no expenses yet.",
+        "all_time": "all time",
+        "total": "Total",
+        "invalid_period": "❗ Give the month as 2024-05, or all.",
     }
 }
 
+# ---------------- caches ----------------
+class RenderCache:
+    """Bounded LRU of rendered replies, each stored with the version it was built from.
+
+    A lookup with a newer version rebuilds the entry in place, so any change to
+    a party (or to a chat's party list) invalidates what was rendered from it.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+
+    def get(self, key, version, build):
+        hit = self._entries.get(key)
+        if hit is not None and hit[0] == version:
+            self._entries.move_to_end(key)
+            return hit[1]
+        value = build()
+        self._entries[key] = (version, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return value
+
+RENDERED = RenderCache(int(os.environ.get("RENDER_CACHE_SIZE", "1024")))
+
 # ---------------- keyboards ----------------
+# Static keyboards are built once per language and shared.
+MAIN_KEYBOARDS = {lang: ReplyKeyboardMarkup(t["buttons"], resize_keyboard=True) for lang, t in TEXT.items()}
+
 def main_keyboard(lang):
-    return ReplyKeyboardMarkup(TEXT[lang]["buttons"], resize_keyboard=True)
+    return MAIN_KEYBOARDS[lang]
 
 def choices_keyboard(items, back_label):
     buttons = [[i] for i in items]
     buttons.append([back_label])
     return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
 
+def party_list_keyboard(m):
+    # rebuilt only when the chat's set of parties changes
+    return RENDERED.get(
+        (m.chat_id, None, "parties", m.lang), m.chat.version,
+        lambda: choices_keyboard(list(m.chat.parties), m.t["back_to_menu"]),
+    )
+
+# add / remove / back
+EDIT_MEMBERS_KEYBOARDS = {
+    lang: ReplyKeyboardMarkup([[t["add_member_btn"], t["remove_member_btn"]], [t["back_btn"]]], resize_keyboard=True)
+    for lang, t in TEXT.items()
+}
+
 def edit_members_keyboard(lang):
-    # add / remove / back
-    if lang == "ua":
-        return ReplyKeyboardMarkup([["➕ Додати учасника", "🗑️ Видалити учасника"], ["↩️ Назад"]], resize_keyboard=True)
-    else:
-        return ReplyKeyboardMarkup([["➕ Add member", "🗑️ Remove member"], ["↩️ Back"]], resize_keyboard=True)
+    return EDIT_MEMBERS_KEYBOARDS[lang]
+
+LANG_LABELS = {"ua": "🇺🇦 Українська", "en": "🇬🇧 English"}
+LANG_KEYBOARD = ReplyKeyboardMarkup([list(LANG_LABELS.values())], resize_keyboard=True)
+LANG_BACK_KEYBOARDS = {
+    lang: ReplyKeyboardMarkup([list(LANG_LABELS.values()), [t["back_to_menu"]]], resize_keyboard=True)
+    for lang, t in TEXT.items()
+}
+
+def lang_keyboard(lang=None):
+    # with a language, add that language's back button
+    return LANG_BACK_KEYBOARDS[lang] if lang else LANG_KEYBOARD
 
 # ---------------- settlements ----------------
-def compute_settlements(members_totals):
-    # members_totals: dict name -> total_spent
-    totals = {u: round(v,2) for u,v in members_totals.items()}
-    n = len(totals) if totals else 1
-    total_sum = round(sum(totals.values()),2)
-    avg = round(total_sum / n, 2) if n else 0.0
-    balances = {u: round(spent - avg, 2) for u, spent in totals.items()}
-    creditors = sorted([(u,b) for u,b in balances.items() if b>0], key=lambda x:-x[1])
-    debtors = sorted([(u,-b) for u,b in balances.items() if b<0], key=lambda x:-x[1])
-    i=j=0
-    debts=[]
-    while i < len(debtors) and j < len(creditors):
-        d_name, d_amt = debtors[i]
-        c_name, c_amt = creditors[j]
-        pay = round(min(d_amt, c_amt),2)
-        if pay>0:
-            debts.append((d_name, c_name, pay))
-        debtors[i] = (d_name, round(d_amt - pay,2))
-        creditors[j] = (c_name, round(c_amt - pay,2))
-        if debtors[i][1] == 0: i += 1
-        if creditors[j][1] == 0: j += 1
-    return avg, balances, debts
+# Up to SETTLE_MAX_EXACT members with a balance get the fewest possible
+# transfers, if the search fits in SETTLE_BUDGET_MS; otherwise greedy pairing.
+settlement.MAX_EXACT = int(os.environ.get("SETTLE_MAX_EXACT", settlement.MAX_EXACT))
+settlement.TIME_BUDGET = float(os.environ.get("SETTLE_BUDGET_MS", settlement.TIME_BUDGET * 1000)) / 1000
+
+# ---------------- outbox ----------------
+# Replies are queued and sent in the background within the flood limits:
+# OUTBOX_CHAT_RATE / OUTBOX_GROUP_RATE messages per second for one private /
+# group chat (bursts of OUTBOX_BURST), OUTBOX_GLOBAL_RATE for the whole bot.
+# A rate of 0 means unlimited. A chat belongs to one shard, so the per-chat
+# limits hold as they are; the bot-wide one is shared, and each of SHARDS
+# workers gets OUTBOX_GLOBAL_RATE / SHARDS of it.
+OUTBOX = Outbox(
+    chat_rate=float(os.environ.get("OUTBOX_CHAT_RATE", "1")),
+    group_rate=float(os.environ.get("OUTBOX_GROUP_RATE", str(20 / 60))),
+    burst=int(os.environ.get("OUTBOX_BURST", "3")),
+    global_rate=float(os.environ.get("OUTBOX_GLOBAL_RATE", "30")) / (SHARDS if SHARD_INDEX is not None else 1),
+)
 
 # ---------------- helper ----------------
 def get_lang(chat_id):
-    return DATA.get(str(chat_id), {}).get("lang", "ua")
+    return STORE.chat(chat_id).lang
 
 def ensure_chat(chat_id):
-    DATA.setdefault(str(chat_id), {"lang": "ua", "parties": {}, "current": None})
+    return STORE.chat(chat_id)
+
+# ---------------- conversation state ----------------
+class State(Enum):
+    MENU = "menu"
+    CREATING_PARTY = "creating_party"
+    CHOOSING_PARTY = "choosing_party"
+    AWAITING_AMOUNT = "awaiting_amount"
+    AWAITING_DESC = "awaiting_desc"
+    EDITING_MEMBERS = "editing_members"
+    ADDING_MEMBER = "adding_member"
+    REMOVING_MEMBER = "removing_member"
+    DELETING_PARTY = "deleting_party"
+    CHOOSING_EXPORT = "choosing_export"
+
+# Each user's state and pending amount/split are kept in STORE as well, so a
+# restart mid-action picks up where the user was. They are saved every
+# PERSIST_LAG seconds; an action left for CONVERSATION_TTL seconds (a day by
+# default) starts over from the menu.
+PERSISTENCE = StorePersistence(
+    STORE,
+    State,
+    ttl=float(os.environ.get("CONVERSATION_TTL", "86400")),
+    update_interval=float(os.environ.get("PERSIST_LAG", "1.0")),
+)
+
+def thread_of(update):
+    # in a forum, replies go to the topic the message was posted in
+    msg = update.effective_message
+    return msg.message_thread_id if msg is not None and msg.is_topic_message else None
+
+class Turn:
+    """One incoming message: who sent it, where, and the chat's current state."""
+    __slots__ = ("update", "context", "chat_id", "thread", "chat", "user", "text", "lang", "t")
+
+    def __init__(self, update, context):
+        self.update = update
+        self.context = context
+        self.chat_id = update.effective_chat.id
+        self.thread = thread_of(update)
+        self.chat = ensure_chat(self.chat_id)
+        self.user = update.effective_user
+        self.text = (update.message.text or "").strip()
+        self.lang = get_lang(self.chat_id)
+        self.t = TEXT[self.lang]
+
+    @property
+    def state(self):
+        return self.context.user_data.get("state", State.MENU)
+
+    @state.setter
+    def state(self, value):
+        self.context.user_data["state"] = value
+
+    @property
+    def current(self):
+        # a selected party that no longer exists counts as none
+        cur = self.chat.current
+        return cur if cur in self.chat.parties else None
+
+    def party(self, name=None):
+        return self.chat.parties[name or self.current]
+
+    async def reply(self, text, reply_markup=None, document=None):
+        OUTBOX.send(self.chat_id, text, reply_markup, document, self.thread)
+
+    async def menu(self, text):
+        await self.reply(text, main_keyboard(self.lang))
 
 # ---------------- handlers ----------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    ensure_chat(chat_id)
+    chat = ensure_chat(chat_id)
     lang = get_lang(chat_id)
     # If language not chosen before, ask; else show menu immediately
-    if DATA[str(chat_id)].get("lang") is None:
-        await update.message.reply_text(TEXT["ua"]["choose_lang"], reply_markup=ReplyKeyboardMarkup([["🇺🇦 Українська","🇬🇧 English"]], resize_keyboard=True))
-    else:
-        await update.message.reply_text(TEXT[lang]["menu"], reply_markup=main_keyboard(lang))
-
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat = update.effective_chat
-    chat_id = chat.id
-    user = update.effective_user
-    text = (update.message.text or "").strip()
-    ensure_chat(chat_id)
-    lang = get_lang(chat_id)
-    t = TEXT[lang]
-
-    # Language selection (first time or via menu)
-    if text in ["🇺🇦 Українська", "🇬🇧 English", "🌐 Мова", "🌐 Language"]:
-        # if explicit language buttons
-        if text == "🇺🇦 Українська":
-            DATA[str(chat_id)]["lang"] = "ua"
-        elif text == "🇬🇧 English":
-            DATA[str(chat_id)]["lang"] = "en"
+    with METRICS.timed("bot_action_seconds", action="start"):
+        if chat.lang is None:
+            OUTBOX.send(chat_id, TEXT["ua"]["choose_lang"], lang_keyboard(), thread_id=thread_of(update))
         else:
-            # Show explicit change language menu
-            await update.message.reply_text(TEXT[lang]["change_lang_prompt"], reply_markup=ReplyKeyboardMarkup([["🇺🇦 Українська","🇬🇧 English"], [t["back_to_menu"]]], resize_keyboard=True))
-            return
-        save_data(DATA)
-        lang = get_lang(chat_id)
-        await update.message.reply_text(TEXT[lang]["menu"], reply_markup=main_keyboard(lang))
+            OUTBOX.send(chat_id, TEXT[lang]["menu"], main_keyboard(lang), thread_id=thread_of(update))
+
+# Language selection (first time or via menu)
+async def on_language_menu(m):
+    await m.reply(m.t["change_lang_prompt"], lang_keyboard(m.lang))
+
+def set_language(code):
+    async def on_set_language(m):
+        save_data(m.chat_id, "lang", lang=code)
+        m.state = State.MENU
+        await m.reply(TEXT[code]["menu"], main_keyboard(code))
+    return on_set_language
+
+async def on_back(m):
+    m.state = State.MENU
+    await m.menu(m.t["back_to_menu"])
+
+# Create party
+async def on_create_party(m):
+    await m.reply(m.t["ask_party_name"], ReplyKeyboardRemove())
+    m.state = State.CREATING_PARTY
+
+async def on_party_name(m):
+    name = m.text
+    if not name:
+        await m.reply(m.t["ask_party_name"])
         return
-
-    # MAIN MENU BUTTONS
-    # Create party
-    if text in [TEXT[lang]["buttons"][0][0], "🎉 Створити вечірку", "🎉 Create party"]:
-        await update.message.reply_text(t["ask_party_name"], reply_markup=ReplyKeyboardRemove())
-        context.user_data["creating_party"] = True
+    # create party, add creator automatically
+    p_name = m.user.username or m.user.first_name
+    save_data(m.chat_id, "party_create", name=name, creator=m.user.id, member=p_name)
+    m.state = State.MENU
+    await m.menu(m.t["party_created"].format(name=name))
+
+# Select party
+async def on_select_party(m):
+    if not m.chat.parties:
+        await m.menu(m.t["no_parties"])
         return
+    await m.reply(m.t["choose_party_prompt"], party_list_keyboard(m))
+    m.state = State.CHOOSING_PARTY
+
+async def on_party_chosen(m):
+    m.state = State.MENU
+    if m.text in m.chat.parties:
+        save_data(m.chat_id, "select", name=m.text)
+        await m.menu(m.t["party_selected"].format(name=m.text))
+    else:
+        await m.menu(m.t["no_parties"])
 
-    if context.user_data.get("creating_party"):
-        name = text
-        if not name:
-            await update.message.reply_text(t["ask_party_name"])
-            return
-        # create party
-        ensure_chat(chat_id)
-        DATA[str(chat_id)]["parties"].setdefault(name, {"creator": user.id, "members": {}, "expenses": []})
-        # add creator automatically
-        p_name = user.username or user.first_name
-        DATA[str(chat_id)]["parties"][name]["members"].setdefault(p_name, 0.0)
-        DATA[str(chat_id)]["current"] = name
-        save_data(DATA)
-        context.user_data["creating_party"] = False
-        await update.message.reply_text(t["party_created"].format(name=name), reply_markup=main_keyboard(lang))
+# Add expense
+async def on_add_expense(m):
+    if not m.current:
+        await m.menu(m.t["no_current_party"])
         return
-
-    # Select party
-    if text in [TEXT[lang]["buttons"][0][1], "🎈 Обрати вечірку", "🎈 Select party"]:
-        parties = list(DATA[str(chat_id)]["parties"].keys())
-        if not parties:
-            await update.message.reply_text(t["no_parties"], reply_markup=main_keyboard(lang))
-            return
-        await update.message.reply_text(t["choose_party_prompt"], reply_markup=choices_keyboard(parties, t["back_to_menu"]))
-        context.user_data["choosing_party"] = True
+    await m.reply(m.t["ask_amount"], ReplyKeyboardRemove())
+    m.state = State.AWAITING_AMOUNT
+
+async def on_amount(m):
+    # parse cents, supporting comma, and an optional split (see party.parse_bill)
+    try:
+        cents, split = parse_bill(m.text)
+    except ValueError:
+        await m.menu(m.t["invalid_amount"])
         return
-
-    if context.user_data.get("choosing_party"):
-        if text == t["back_to_menu"] or text in ["↩️ Назад","↩️ Back"]:
-            context.user_data["choosing_party"] = False
-            await update.message.reply_text(t["back_to_menu"], reply_markup=main_keyboard(lang))
+    if split:
+        members = m.party().members if m.current else {}
+        unknown = sorted({u for _, who in split for u, _ in who if u not in members})
+        if unknown:
+            await m.menu(m.t["split_unknown"].format(names=", ".join(unknown)))
             return
-        if text in DATA[str(chat_id)]["parties"]:
-            DATA[str(chat_id)]["current"] = text
-            save_data(DATA)
-            context.user_data["choosing_party"] = False
-            await update.message.reply_text(t["party_selected"].format(name=text), reply_markup=main_keyboard(lang))
-        else:
-            await update.message.reply_text(t["no_parties"], reply_markup=main_keyboard(lang))
+        m.context.user_data["pending_split"] = split_to_ops(split)
+    m.context.user_data["pending_amount"] = cents
+    m.state = State.AWAITING_DESC
+    await m.reply(m.t["ask_desc"], ReplyKeyboardRemove())
+
+async def on_description(m):
+    desc = m.text if m.text and m.text != "-" else ""
+    cents = m.context.user_data.pop("pending_amount", 0)
+    split = m.context.user_data.pop("pending_split", None)
+    m.state = State.MENU
+    if not m.current:
+        await m.menu(m.t["no_current_party"])
         return
-
-    # Add expense (init)
-    if text in [TEXT[lang]["buttons"][1][0], "➕ Додати витрату", "➕ Add expense"]:
-        if not DATA[str(chat_id)].get("current"):
-            await update.message.reply_text(t["no_current_party"], reply_markup=main_keyboard(lang))
-            return
-        await update.message.reply_text(t["ask_amount"], reply_markup=ReplyKeyboardRemove())
-        context.user_data["awaiting_amount"] = True
+    payer = m.user.username or m.user.first_name
+    op = {"split": split} if split else {}
+    save_data(m.chat_id, "expense", party=m.current, user=payer, cents=cents, desc=desc, ts=datetime.utcnow().isoformat(), **op)
+    await m.menu(m.t["expense_added"].format(amount=money(cents), user=payer))
+
+# Members list
+async def on_members(m):
+    if not m.current:
+        await m.menu(m.t["no_current_party"])
         return
-
-    # Awaiting amount
-    if context.user_data.get("awaiting_amount"):
-        # parse float supporting comma
-        try:
-            amt = float(text.replace(",", "."))
-            if amt < 0:
-                raise ValueError
-        except Exception:
-            await update.message.reply_text(t["invalid_amount"], reply_markup=main_keyboard(lang))
-            return
-        context.user_data["pending_amount"] = round(amt, 2)
-        context.user_data["awaiting_amount"] = False
-        context.user_data["awaiting_desc"] = True
-        await update.message.reply_text(t["ask_desc"], reply_markup=ReplyKeyboardRemove())
+    members = m.party().members
+    if not members:
+        await m.menu(m.t["members_none"])
         return
-
-    # Awaiting description -> save expense
-    if context.user_data.get("awaiting_desc"):
-        desc = text if text and text != "-" else ""
-        amt = context.user_data.pop("pending_amount", 0.0)
-        context.user_data["awaiting_desc"] = False
-        cur = DATA[str(chat_id)].get("current")
-        if not cur:
-            await update.message.reply_text(t["no_current_party"], reply_markup=main_keyboard(lang))
-            return
-        party = DATA[str(chat_id)]["parties"].setdefault(cur, {"creator": None, "members": {}, "expenses": []})
-        payer = user.username or user.first_name
-        party["members"].setdefault(payer, 0.0)
-        party["expenses"].append({"user": payer, "amount": amt, "desc": desc, "ts": datetime.utcnow().isoformat()})
-        party["members"][payer] = round(party["members"].get(payer, 0.0) + amt, 2)
-        save_data(DATA)
-        await update.message.reply_text(t["expense_added"].format(amount=amt, user=payer), reply_markup=main_keyboard(lang))
+    msg = m.t["members_list"]
+    for u, tot in members.items():
+        msg += f"• {u}: {money(tot)}\n"
+    await m.menu(msg)
+
+# Edit members
+async def on_edit_members(m):
+    await m.reply(m.t["edit_members_menu"], edit_members_keyboard(m.lang))
+    m.state = State.EDITING_MEMBERS
+
+async def on_add_member(m):
+    await m.reply(m.t["ask_member_name"], ReplyKeyboardRemove())
+    m.state = State.ADDING_MEMBER
+
+async def on_remove_member(m):
+    await m.reply(m.t["ask_member_name"], ReplyKeyboardRemove())
+    m.state = State.REMOVING_MEMBER
+
+async def on_member_name(m):
+    name = m.text.replace("@", "").strip()
+    if not name:
+        await m.reply(m.t["ask_member_name"])
         return
+    adding = m.state is State.ADDING_MEMBER
+    m.state = State.MENU
+    if not m.current:
+        await m.menu(m.t["no_current_party"])
+        return
+    if adding:
+        save_data(m.chat_id, "member_add", party=m.current, name=name)
+        await m.menu(m.t["member_added"].format(name=name))
+    elif name in m.party().members:
+        save_data(m.chat_id, "member_remove", party=m.current, name=name)
+        await m.menu(m.t["member_removed"].format(name=name))
+    else:
+        await m.menu(m.t["member_not_found"])
 
-    # Members list
-    if text in [TEXT[lang]["buttons"][1][1], "👥 Учасники", "👥 Members"]:
-        cur = DATA[str(chat_id)].get("current")
-        if not cur:
-            await update.message.reply_text(t["no_current_party"], reply_markup=main_keyboard(lang))
-            return
-        party = DATA[str(chat_id)]["parties"].get(cur, {})
-        members = party.get("members", {})
-        if not members:
-            await update.message.reply_text(t["members_none"], reply_markup=main_keyboard(lang))
-            return
-        msg = t["members_list"]
-        for u, tot in members.items():
-            msg += f"• {u}: {tot:.2f}\n"
-        await update.message.reply_text(msg, reply_markup=main_keyboard(lang))
+# Manage / delete parties
+async def on_manage_parties(m):
+    if not m.chat.parties:
+        await m.menu(m.t["no_parties"])
+        return
+    await m.reply(m.t["choose_party_to_delete"], party_list_keyboard(m))
+    m.state = State.DELETING_PARTY
+
+async def on_party_to_delete(m):
+    m.state = State.MENU
+    selected = m.text
+    if selected not in m.chat.parties:
+        await m.menu(m.t["party_not_found"])
         return
+    creator = m.party(selected).creator
+    if creator is None or int(m.user.id) == int(creator):
+        save_data(m.chat_id, "party_delete", name=selected)
+        await m.menu(m.t["party_deleted"].format(name=selected))
+    else:
+        await m.menu(m.t["no_permission_delete"])
+
+# Summary
+def render_summary(t, cur, party):
+    avg, balances, debts = party.settlements()
+    lines = [t["summary_header"], f"Party: {cur}", ""]
+    for u,tot in party.members.items():
+        lines.append(f"{u}: {money(tot)}")
+    lines.append("")
+    lines.append(f"Average: {money(avg)}")
+    lines.append("")
+    if debts:
+        lines.append("Suggested transfers:")
+        for d,c,a in debts:
+            lines.append(f"{d} -> {c} : {money(a)}")
+    else:
+        lines.append(t["all_settled"])
+    return "\n".join(lines)
 
-    # Edit members menu
-    if text in ["✏️ Редагувати учасників", "✏️ Edit members", TEXT[lang]["buttons"][2][0]]:
-        await update.message.reply_text(t["edit_members_menu"], reply_markup=edit_members_keyboard(lang))
-        context.user_data["editing_members"] = True
+async def on_summary(m):
+    cur = m.current
+    if not cur:
+        await m.menu(m.t["no_current_party"])
         return
+    party = m.party()
+    if not party.members:
+        await m.menu(m.t["members_none"])
+        return
+    text = RENDERED.get((m.chat_id, cur, "summary", m.lang), party.version, lambda: render_summary(m.t, cur, party))
+    await m.menu(text)
 
-    if context.user_data.get("editing_members"):
-        # Add member
-        if text in ["➕ Додати учасника", "➕ Add member"]:
-            await update.message.reply_text(t["ask_member_name"], reply_markup=ReplyKeyboardRemove())
-            context.user_data["adding_member"] = True
-            context.user_data["editing_members"] = False
-            return
-        # Remove member
-        if text in ["🗑️ Видалити учасника", "🗑️ Remove member"]:
-            await update.message.reply_text(t["ask_member_name"], reply_markup=ReplyKeyboardRemove())
-            context.user_data["removing_member"] = True
-            context.user_data["editing_members"] = False
-            return
-        # Back
-        if text in ["↩️ Назад", "↩️ Back", t["back_to_menu"]]:
-            context.user_data["editing_members"] = False
-            await update.message.reply_text(t["back_to_menu"], reply_markup=main_keyboard(lang))
-            return
+# Export
+EXPORT_LABELS = {"TXT": "txt", "CSV": "csv", "JSON": "json"}
 
-    if context.user_data.get("adding_member"):
-        name = text.replace("@", "").strip()
-        if not name:
-            await update.message.reply_text(t["ask_member_name"])
-            return
-        cur = DATA[str(chat_id)].get("current")
-        if not cur:
-            await update.message.reply_text(t["no_current_party"], reply_markup=main_keyboard(lang))
-            context.user_data["adding_member"] = False
-            return
-        party = DATA[str(chat_id)]["parties"].setdefault(cur, {"creator": None, "members": {}, "expenses": []})
-        party["members"].setdefault(name, 0.0)
-        save_data(DATA)
-        context.user_data["adding_member"] = False
-        await update.message.reply_text(t["member_added"].format(name=name), reply_markup=main_keyboard(lang))
-        return
+EXPORT_KEYBOARDS = {
+    lang: ReplyKeyboardMarkup([list(EXPORT_LABELS), [t["back_btn"]]], resize_keyboard=True)
+    for lang, t in TEXT.items()
+}
 
-    if context.user_data.get("removing_member"):
-        name = text.replace("@","").strip()
-        if not name:
-            await update.message.reply_text(t["ask_member_name"])
-            return
-        cur = DATA[str(chat_id)].get("current")
-        if not cur:
-            await update.message.reply_text(t["no_current_party"], reply_markup=main_keyboard(lang))
-            context.user_data["removing_member"] = False
-            return
-        party = DATA[str(chat_id)]["parties"].get(cur, {})
-        if name in party.get("members", {}):
-            del party["members"][name]
-            # leave historical expenses (optional: remove expense records)
-            save_data(DATA)
-            await update.message.reply_text(t["member_removed"].format(name=name), reply_markup=main_keyboard(lang))
-        else:
-            await update.message.reply_text("❗ Учасника не знайдено.", reply_markup=main_keyboard(lang))
-        context.user_data["removing_member"] = False
-        return
+def export_keyboard(lang):
+    return EXPORT_KEYBOARDS[lang]
 
-    # Manage / delete parties
-    if text in ["🗑️ Керування вечірками", "🗑️ Manage parties", TEXT[lang]["buttons"][2][1]]:
-        parties = list(DATA[str(chat_id)]["parties"].keys())
-        if not parties:
-            await update.message.reply_text(t["no_parties"], reply_markup=main_keyboard(lang))
-            return
-        await update.message.reply_text(t["choose_party_to_delete"], reply_markup=choices_keyboard(parties, t["back_to_menu"]))
-        context.user_data["deleting_party"] = True
+async def on_export(m):
+    if not m.current:
+        await m.menu(m.t["export_no_party"])
         return
-
-    if context.user_data.get("deleting_party"):
-        if text in [t["back_to_menu"], "↩️ Назад", "↩️ Back"]:
-            context.user_data["deleting_party"] = False
-            await update.message.reply_text(t["back_to_menu"], reply_markup=main_keyboard(lang))
-            return
-        selected = text.strip()
-        if selected in DATA[str(chat_id)]["parties"]:
-            party = DATA[str(chat_id)]["parties"][selected]
-            creator = party.get("creator")
-            if creator is None or int(user.id) == int(creator):
-                del DATA[str(chat_id)]["parties"][selected]
-                if DATA[str(chat_id)].get("current") == selected:
-                    DATA[str(chat_id)]["current"] = None
-                save_data(DATA)
-                await update.message.reply_text(t["party_deleted"].format(name=selected), reply_markup=main_keyboard(lang))
-            else:
-                await update.message.reply_text(t["no_permission_delete"], reply_markup=main_keyboard(lang))
-        else:
-            await update.message.reply_text("❌ Такої вечірки немає.", reply_markup=main_keyboard(lang))
-        context.user_data["deleting_party"] = False
+    await m.reply(m.t["export_format"], export_keyboard(m.lang))
+    m.state = State.CHOOSING_EXPORT
+
+async def on_export_format(m):
+    m.state = State.MENU
+    fmt = EXPORT_LABELS.get(m.text.upper())
+    cur = m.current
+    if fmt is None:
+        await m.menu(m.t["menu"])
         return
-
-    # Summary
-    if text in [TEXT[lang]["buttons"][3][0], "📊 Підсумок", "📊 Summary"]:
-        cur = DATA[str(chat_id)].get("current")
-        if not cur:
-            await update.message.reply_text(t["no_current_party"], reply_markup=main_keyboard(lang))
-            return
-        party = DATA[str(chat_id)]["parties"].get(cur, {})
-        members = party.get("members", {})
-        if not members:
-            await update.message.reply_text(t["members_none"], reply_markup=main_keyboard(lang))
-            return
-        avg, balances, debts = compute_settlements(members)
-        lines = [t["summary_header"], f"Party: {cur}", ""]
-        for u,tot in members.items():
-            lines.append(f"{u}: {tot:.2f}")
-        lines.append("")
-        lines.append(f"Average: {avg:.2f}")
-        lines.append("")
-        if debts:
-            lines.append("Suggested transfers:")
-            for d,c,a in debts:
-                lines.append(f"{d} -> {c} : {a:.2f}")
-        else:
-            lines.append(t["all_settled"])
-        await update.message.reply_text("\n".join(lines), reply_markup=main_keyboard(lang))
+    if not cur:
+        await m.menu(m.t["export_no_party"])
         return
-
-    # Export TXT
-    if text in [TEXT[lang]["buttons"][3][1], "📤 Експорт у TXT", "📤 Export to TXT"]:
-        cur = DATA[str(chat_id)].get("current")
-        if not cur:
-            await update.message.reply_text(t["export_no_party"], reply_markup=main_keyboard(lang))
+    await m.reply(m.t["export_generating"], ReplyKeyboardRemove())
+    # the chat lock is held meanwhile, so the party cannot change under the worker
+    loop = asyncio.get_running_loop()
+    f, filename = await loop.run_in_executor(None, export.generate, cur, m.party(), fmt)
+    with f:
+        # the upload needs the bytes in one piece; this is the only full copy
+        await m.reply(m.t["export_done"], document=InputFile(f.read(), filename=filename))
+    # the outbox folds this into the document's caption, so the chat gets one message
+    await m.menu(m.t["export_done"])
+
+# ---------------- reports ----------------
+# /spent [YYYY-MM|all]: the chat's spending in a month (this one by default),
+# by party and by member. /history [name]: one member's spending by month and
+# by party (the sender by default). Both read the rollups kept by party.py,
+# so they cost the same however many expenses the chat has.
+def parse_period(args):
+    if not args:
+        return datetime.utcnow().strftime("%Y-%m")
+    if args[0].lower() == "all":
+        return None
+    return datetime.strptime(args[0], "%Y-%m").strftime("%Y-%m")
+
+def spent_line(label, cents, n):
+    return f"{label}: {money(cents)} ({n})"
+
+def render_spent(t, chat, month):
+    period = month or t["all_time"]
+    cents, n = chat.rollup.get(None, month)
+    if not n:
+        return t["spent_none"].format(period=period)
+    lines = [t["spent_header"].format(period=period), spent_line(t["total"], cents, n), ""]
+    for name, party in chat.parties.items():
+        c, k = party.rollup.get(None, month)
+        if k:
+            lines.append(spent_line(f"🎈 {name}", c, k))
+    lines.append("")
+    by_member = sorted(((*chat.rollup.get(u, month), u) for u in chat.rollup.members(month)), key=lambda x: -x[0])
+    for c, k, u in by_member:
+        lines.append(spent_line(f"• {u}", c, k))
+    return "\n".join(lines)
+
+def render_history(t, chat, name):
+    cents, n = chat.rollup.get(name)
+    if not n:
+        return t["history_none"].format(name=name)
+    lines = [t["history_header"].format(name=name)]
+    for month, c, k in chat.rollup.history(name):
+        lines.append(spent_line(month, c, k))
+    lines.append("")
+    for party_name, party in chat.parties.items():
+        c, k = party.rollup.get(name)
+        if k:
+            lines.append(spent_line(f"🎈 {party_name}", c, k))
+    lines.append(spent_line(t["total"], cents, n))
+    return "\n".join(lines)
+
+async def spent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    chat = ensure_chat(chat_id)
+    t = TEXT[chat.lang]
+    with METRICS.timed("bot_action_seconds", action="spent"):
+        try:
+            month = parse_period(context.args)
+        except ValueError:
+            OUTBOX.send(chat_id, t["invalid_period"], thread_id=thread_of(update))
             return
-        await update.message.reply_text(t["export_generating"], reply_markup=ReplyKeyboardRemove())
-        party = DATA[str(chat_id)]["parties"].get(cur, {})
-        members = party.get("members", {})
-        expenses = party.get("expenses", [])
-        avg, balances, debts = compute_settlements(members)
-        lines = []
-        lines.append(f"Party: {cur}")
-        lines.append(f"Creator ID: {party.get('creator')}")
-        lines.append(f"Generated: {datetime.utcnow().isoformat()} UTC")
-        lines.append("")
-        lines.append("Members and totals:")
-        for u,tot in members.items():
-            lines.append(f" - {u}: {tot:.2f}")
-        lines.append("")
-        lines.append(f"Total: {sum(members.values()):.2f}")
-        lines.append(f"Average: {avg:.2f}")
-        lines.append("")
-        lines.append("Balances (positive => should receive):")
-        for u,b in balances.items():
-            lines.append(f" - {u}: {b:+.2f}")
-        lines.append("")
-        lines.append("Suggested transfers:")
-        if debts:
-            for d,c,a in debts:
-                lines.append(f" - {d} -> {c} : {a:.2f}")
-        else:
-            lines.append(" - All settled")
-        txt = "\n".join(lines)
-        bio = io.BytesIO(txt.encode("utf-8"))
-        bio.name = f"{cur}_summary.txt"
-        await update.message.reply_document(InputFile(bio), caption=t["export_done"])
-        await update.message.reply_text(t["export_done"], reply_markup=main_keyboard(lang))
-        return
+        OUTBOX.send(chat_id, render_spent(t, chat, month), thread_id=thread_of(update))
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    chat = ensure_chat(chat_id)
+    user = update.effective_user
+    # same name on_description records the payer under
+    name = " ".join(context.args).replace("@", "").strip() or user.username or user.first_name
+    with METRICS.timed("bot_action_seconds", action="history"):
+        OUTBOX.send(chat_id, render_history(TEXT[chat.lang], chat, name), thread_id=thread_of(update))
+
+# ---------------- dispatch ----------------
+# Main menu actions, laid out like TEXT[lang]["buttons"].
+MENU_ACTIONS = [
+    [on_create_party, on_select_party],
+    [on_add_expense, on_members],
+    [on_edit_members, on_manage_parties],
+    [on_summary, on_export],
+    [on_language_menu],
+]
+
+def build_dispatch():
+    """Map every localized label to its handler, once, at startup.
+
+    Returns (buttons, state_buttons, state_input): buttons work from any
+    state, state_buttons only inside the given state, and state_input takes
+    free text typed while in a state.
+    """
+    buttons = {label: set_language(code) for code, label in LANG_LABELS.items()}
+    # labels from keyboards sent before Export offered several formats
+    buttons["📤 Експорт у TXT"] = buttons["📤 Export to TXT"] = on_export
+    state_buttons = {State.EDITING_MEMBERS: {}}
+    for t in TEXT.values():
+        for row, actions in zip(t["buttons"], MENU_ACTIONS):
+            for label, action in zip(row, actions):
+                buttons[label] = action
+        buttons[t["back_btn"]] = on_back
+        buttons[t["back_to_menu"]] = on_back
+        state_buttons[State.EDITING_MEMBERS][t["add_member_btn"]] = on_add_member
+        state_buttons[State.EDITING_MEMBERS][t["remove_member_btn"]] = on_remove_member
+    state_input = {
+        State.CREATING_PARTY: on_party_name,
+        State.CHOOSING_PARTY: on_party_chosen,
+        State.AWAITING_AMOUNT: on_amount,
+        State.AWAITING_DESC: on_description,
+        State.ADDING_MEMBER: on_member_name,
+        State.REMOVING_MEMBER: on_member_name,
+        State.DELETING_PARTY: on_party_to_delete,
+        State.CHOOSING_EXPORT: on_export_format,
+    }
+    return buttons, state_buttons, state_input
 
-    # fallback: show menu
-    await update.message.reply_text(t["menu"], reply_markup=main_keyboard(lang))
-    return
+BUTTONS, STATE_BUTTONS, STATE_INPUT = build_dispatch()
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    m = Turn(update, context)
+    state = m.state
+    action = BUTTONS.get(m.text) or STATE_BUTTONS.get(state, {}).get(m.text) or STATE_INPUT.get(state)
+    if action is None:
+        # fallback: show menu
+        m.state = State.MENU
+        await m.menu(m.t["menu"])
+        return
+    name = action.__name__
+    with METRICS.timed("bot_action_seconds", action=name), (PROFILER.watch(name) if PROFILER else nullcontext()):
+        await action(m)
+
+# ---------------- per-chat ordering ----------------
+# Updates run concurrently, but everything for one chat goes through that
+# chat's lock. asyncio.Lock wakes waiters in FIFO order, so a chat's updates
+# are still handled in the order they arrived. Idle locks are dropped.
+CHAT_LOCKS = weakref.WeakValueDictionary()
+
+def chat_lock(chat_id):
+    lock = CHAT_LOCKS.get(chat_id)
+    if lock is None:
+        lock = CHAT_LOCKS[chat_id] = asyncio.Lock()
+    return lock
+
+def per_chat(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with chat_lock(update.effective_chat.id):
+            await handler(update, context)
+    return wrapper
+
+# ---------------- metrics ----------------
+# METRICS_PORT serves Prometheus text on http://METRICS_HOST:METRICS_PORT/metrics;
+# /stats shows the same numbers to the user ids listed in ADMIN_IDS.
+# PROFILE_SLOW_MS prints sampled stacks for updates slower than that.
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()}
+PROFILER = SlowUpdateProfiler(float(os.environ["PROFILE_SLOW_MS"]) / 1000) if os.environ.get("PROFILE_SLOW_MS") else None
+
+METRICS.describe("bot_action_seconds", "Time to handle one update, by handler")
+METRICS.describe("bot_save_seconds", "Time save_data spends on the event loop")
+METRICS.describe("bot_persist_seconds", "Time the writer thread spends on one batch")
+METRICS.describe("bot_persist_ops_total", "Ops written to storage")
+METRICS.describe("bot_persist_bytes_total", "Journal bytes written")
+METRICS.describe("bot_api_seconds", "Telegram Bot API call time, by method")
+METRICS.describe("bot_errors_total", "Errors raised by handlers")
+METRICS.describe("bot_settle_greedy_total", "Settlements paired greedily instead of searched, by reason")
+METRICS.describe("bot_outbox_delay_seconds", "Time a reply waited in the outbox")
+METRICS.describe("bot_outbox_sent_total", "Messages sent by the outbox")
+METRICS.describe("bot_outbox_coalesced_total", "Replies folded into the message before them")
+METRICS.describe("bot_outbox_retries_total", "Sends retried, by reason")
+METRICS.describe("bot_outbox_dropped_total", "Messages given up on")
+
+def on_write(seconds, ops, nbytes):
+    METRICS.observe("bot_persist_seconds", seconds)
+    METRICS.inc("bot_persist_ops_total", ops)
+    METRICS.inc("bot_persist_bytes_total", nbytes)
+
+STORE.on_write = on_write
+
+def loaded_parties():
+    return [p for chat in list(STORE.loaded().values()) for p in list(chat.parties.values())]
+
+METRICS.gauge("bot_chats_loaded", lambda: len(STORE.loaded()))
+METRICS.gauge("bot_parties_loaded", lambda: len(loaded_parties()))
+METRICS.gauge("bot_expenses_loaded", lambda: sum(len(p.expenses) for p in loaded_parties()))
+METRICS.gauge("bot_outbox_queued", lambda: OUTBOX.queued)
+
+class TimedRequest(HTTPXRequest):
+    async def do_request(self, url, method, *args, **kwargs):
+        with METRICS.timed("bot_api_seconds", method=url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+def stats_text():
+    lines = [
+        f"Chats loaded: {len(STORE.loaded())}",
+        f"Parties: {len(loaded_parties())}",
+        f"Expenses: {sum(len(p.expenses) for p in loaded_parties())}",
+        f"Errors: {METRICS.counters[('bot_errors_total', ())]}",
+        "",
+        "p50 / p95 ms (count):",
+    ]
+    for (name, labels), h in sorted(METRICS.histograms.items()):
+        label = ",".join(str(v) for _, v in labels)
+        lines.append(f"{name.removeprefix('bot_').removesuffix('_seconds')}{'[' + label + ']' if label else ''}: "
+                     f"{h.quantile(0.5) * 1000:g} / {h.quantile(0.95) * 1000:g} ({h.count})")
+    return "\n".join(lines)
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    OUTBOX.send(update.effective_chat.id, stats_text(), thread_id=thread_of(update))
+
+# ---------------- webhook ----------------
+# WEBHOOK_URL (the public https URL Telegram posts to) switches from polling to
+# a webhook served on WEBHOOK_LISTEN:WEBHOOK_PORT at WEBHOOK_PATH. Requests
+# must carry WEBHOOK_SECRET. At most UPDATE_QUEUE_SIZE updates wait or run at
+# once; past that Telegram gets 503 and retries. GET HEALTH_PATH reports status.
+def webhook_server(app):
+    METRICS.describe("bot_webhook_updates_total", "Updates accepted over the webhook")
+    METRICS.describe("bot_webhook_rejected_total", "Webhook requests refused, by reason")
+    server = WebhookServer(
+        app,
+        os.environ.get("WEBHOOK_LISTEN", "0.0.0.0"),
+        int(os.environ.get("WEBHOOK_PORT", "8443")),
+        os.environ.get("WEBHOOK_PATH", "/telegram"),
+        secret=os.environ.get("WEBHOOK_SECRET") or None,
+        health_path=os.environ.get("HEALTH_PATH", "/healthz"),
+        limit=int(os.environ.get("UPDATE_QUEUE_SIZE", "1000")),
+        cert=os.environ.get("WEBHOOK_CERT") or None,
+        key=os.environ.get("WEBHOOK_KEY") or None,
+    )
+    METRICS.gauge("bot_webhook_pending", lambda: server.pending)
+    return server
 
 # ---------------- errors ----------------
 async def err_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    METRICS.inc("bot_errors_total")
     print("Error:", context.error)
 
 # ---------------- main ----------------
@@ -479,14 +816,54 @@ def main():
     if not token:
         print("ERROR: set BOT_TOKEN environment variable")
         return
-    app = ApplicationBuilder().token(token).build()
-    app.add_handler(CommandHandler("start", start))
-    # respond when added to group
-    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # CONCURRENT_UPDATES: how many updates (from different chats) may run at once
+    concurrency = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+    # TELEGRAM_API_URL points the bot at another Bot API server (e.g. fake_telegram.py)
+    api_url = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .base_url(api_url)
+        .request(TimedRequest(connection_pool_size=256))
+    )
+    metrics_port = int(os.environ.get("METRICS_PORT") or 0)
+    if IS_FRONT:
+        # worker i serves its metrics on METRICS_PORT + 1 + i
+        router = ShardRouter(SHARDS, os.path.abspath(__file__), {
+            i: {"METRICS_PORT": str(metrics_port + 1 + i)} for i in range(SHARDS) if metrics_port
+        })
+        # one update at a time keeps them in arrival order on their way to the workers
+        app = builder.concurrent_updates(False).post_init(router.start).post_shutdown(router.stop).build()
+        app.add_handler(TypeHandler(Update, router.forward))
+    else:
+        app = (builder.concurrent_updates(concurrency).persistence(PERSISTENCE)
+               .post_init(OUTBOX.start).post_stop(OUTBOX.stop).build())
+        app.add_handler(CommandHandler("start", per_chat(start)))
+        app.add_handler(CommandHandler("stats", stats))
+        app.add_handler(CommandHandler("spent", per_chat(spent)))
+        app.add_handler(CommandHandler("history", per_chat(history)))
+        # respond when added to group
+        app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, per_chat(start)))
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_chat(handle_message)))
     app.add_error_handler(err_handler)
-    print("Bot started")
-    app.run_polling()
+    if metrics_port:
+        serve(METRICS, os.environ.get("METRICS_HOST", "127.0.0.1"), metrics_port)
+    if PROFILER:
+        PROFILER.start()
+    try:
+        if SHARD_INDEX is not None:
+            print(f"Worker {SHARD_INDEX} of {SHARDS} started")
+            asyncio.run(run_worker(app, int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))))
+            return
+        print("Bot started" if not IS_FRONT else f"Bot started with {SHARDS} workers")
+        if os.environ.get("WEBHOOK_URL"):
+            asyncio.run(run_webhook(app, webhook_server(app), os.environ["WEBHOOK_URL"],
+                                    int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))))
+        else:
+            app.run_polling()
+    finally:
+        # write out everything still queued before the process exits
+        STORE.close()
 
 if __name__ == "__main__":
     main()
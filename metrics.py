@@ -0,0 +1,196 @@
+# metrics.py
+import sys
+import time
+import threading
+from bisect import bisect_left
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; the last bucket is +Inf.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# ---------------- histograms ----------------
+class Histogram:
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (inf if past the last)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS + (float("inf"),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Registry:
+    """Histograms, counters and gauges, exported in Prometheus text format.
+
+    Writers may be on any thread; the lock guards creating a series and
+    bumping counters.
+    Gauges are callbacks evaluated at scrape time.
+    """
+
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = Counter()  # (name, labels) -> value
+        self.gauges = {}  # name -> callable returning a number
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        h = self.histograms.get(key)
+        if h is None:
+            with self._lock:
+                h = self.histograms.setdefault(key, Histogram())
+        return h
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    @contextmanager
+    def timed(self, name, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def render(self):
+        out = []
+        typed = set()
+
+        def head(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    out.append(f"# HELP {name} {self.help[name]}")
+                out.append(f"# TYPE {name} {kind}")
+
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+        for (name, labels), h in sorted(self.histograms.items()):
+            head(name, "histogram")
+            seen = 0
+            for bound, n in zip(BUCKETS, h.counts):
+                seen += n
+                out.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {seen}")
+            out.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {h.count}")
+            out.append(f"{name}_sum{fmt(labels)} {h.sum}")
+            out.append(f"{name}_count{fmt(labels)} {h.count}")
+        for (name, labels), v in sorted(self.counters.items()):
+            head(name, "counter")
+            out.append(f"{name}{fmt(labels)} {v}")
+        for name, fn in sorted(self.gauges.items()):
+            head(name, "gauge")
+            out.append(f"{name} {fn()}")
+        return "\n".join(out) + "\n"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+METRICS = Registry()
+
+# ---------------- HTTP endpoint ----------------
+def serve(registry, host, port):
+    """Serve GET /metrics from a daemon thread; returns the server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+# ---------------- sampling profiler ----------------
+class SlowUpdateProfiler:
+    """Samples the event loop thread's stack every ``interval`` seconds.
+
+    When an update takes longer than ``threshold``, the samples taken while it
+    ran are folded into the most frequent stacks and printed. Updates run
+    concurrently on one loop, so the stacks show what the loop was busy with
+    during that window, not only that update's own frames.
+    """
+
+    def __init__(self, threshold, interval=0.005, keep=4000, top=5):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self._samples = deque(maxlen=keep)  # (time, stack)
+        self._thread_id = None
+        self._active = 0
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        threading.Thread(target=self._run, name="profiler", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self._active:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None and len(stack) < 12:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno} {code.co_name}")
+                frame = frame.f_back
+            self._samples.append((time.perf_counter(), tuple(stack)))
+
+    @contextmanager
+    def watch(self, label):
+        self._active += 1
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._active -= 1
+            elapsed = time.perf_counter() - t0
+            if elapsed >= self.threshold:
+                self.report(label, t0, t0 + elapsed)
+
+    def report(self, label, began, ended):
+        stacks = Counter(s for t, s in list(self._samples) if began <= t <= ended)
+        print(f"Slow update: {label} took {(ended - began) * 1000:.0f} ms, {sum(stacks.values())} samples")
+        for stack, n in stacks.most_common(self.top):
+            print(f"  {n}x " + " <- ".join(stack[:6]))
@@ -0,0 +1,236 @@
+# outbox.py
+import asyncio
+import heapq
+import itertools
+from collections import deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from metrics import METRICS
+
+# Bot API limits
+MAX_TEXT = 4096
+MAX_CAPTION = 1024
+
+# ---------------- token bucket ----------------
+class TokenBucket:
+    """``rate`` tokens per second, at most ``burst`` saved up; rate 0 means no limit."""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now):
+        if not self.rate:
+            return now
+        self._refill(now)
+        return now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+    def full(self, now):
+        return not self.rate or self.tokens + (now - self.updated) * self.rate >= self.burst
+
+# ---------------- messages ----------------
+class Outgoing:
+    __slots__ = ("text", "markup", "document", "thread", "queued", "attempts")
+
+    def __init__(self, text, markup=None, document=None, thread=None, queued=0.0):
+        self.text = text  # message text, or the caption of a document
+        self.markup = markup
+        self.document = document
+        self.thread = thread  # forum topic the reply goes to, None for the chat itself
+        self.queued = queued
+        self.attempts = 0
+
+    def absorb(self, nxt):
+        """Fold the message queued right after this one into it, if they fit in one."""
+        if nxt.document is not None or nxt.thread != self.thread:
+            return False
+        if nxt.text == self.text:
+            joined = self.text
+        else:
+            joined = f"{self.text}\n\n{nxt.text}" if self.text else nxt.text
+        if len(joined) > (MAX_TEXT if self.document is None else MAX_CAPTION):
+            return False
+        self.text = joined
+        # the later keyboard is the one that would have been left on screen
+        self.markup = nxt.markup or self.markup
+        return True
+
+# ---------------- scheduler ----------------
+class Outbox:
+    """Sends replies for the handlers, within Telegram's flood limits.
+
+    ``send`` only queues the message and returns. Every chat has its own FIFO
+    queue and token bucket, and one more bucket covers the whole bot. A chat
+    has at most one request in flight, so its messages arrive in order. Whatever
+    piled up in a chat's queue while it waited for a token goes out as one
+    message where Bot API limits allow: texts for the same forum topic are
+    joined and a text right after a document joins its caption. A 429 puts the
+    message back and pauses that chat for the retry-after Telegram asked for.
+    Network errors are retried with backoff. Any other error drops the message.
+    """
+
+    def __init__(self, chat_rate=1.0, group_rate=20 / 60, burst=3, global_rate=30.0, max_attempts=5):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.bot = None
+        self._global = None
+        self._global_rate = global_rate
+        self._queues = {}  # chat id -> deque of Outgoing
+        self._buckets = {}  # chat id -> TokenBucket
+        self._paused = {}  # chat id -> loop time a 429 told us to wait for
+        self._heap = []  # (ready at, tiebreak, chat id) for chats with nothing in flight
+        self._scheduled = set()
+        self._inflight = set()
+        self._tiebreak = itertools.count()
+        self._wake = None
+        self._idle = None
+        self._runner = None
+
+    @property
+    def queued(self):
+        return sum(len(q) for q in self._queues.values())
+
+    async def start(self, app):
+        loop = asyncio.get_running_loop()
+        self.bot = app.bot
+        self._global = TokenBucket(self._global_rate, max(1, self._global_rate), loop.time())
+        self._wake = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        for chat_id in self._queues:
+            self._schedule(chat_id, loop.time())
+        self._runner = asyncio.create_task(self._run(), name="outbox")
+
+    async def stop(self, app=None, timeout=30.0):
+        # deliver what is queued, then stop
+        if self._runner is None:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Outbox: dropping {self.queued} unsent messages")
+        self._runner.cancel()
+        self._runner = None
+
+    def send(self, chat_id, text, reply_markup=None, document=None, thread_id=None):
+        """Queue a message (or a document with ``text`` as its caption) for ``chat_id``,
+        in forum topic ``thread_id`` if given."""
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+        now = asyncio.get_running_loop().time()
+        queue.append(Outgoing(text, reply_markup, document, thread_id, now))
+        if self._runner is not None:
+            self._idle.clear()
+            self._schedule(chat_id, now)
+
+    def _bucket(self, chat_id, now):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # group chats (negative ids) have a much lower limit than private ones
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.burst, now)
+        return bucket
+
+    def _schedule(self, chat_id, now):
+        if chat_id in self._scheduled or chat_id in self._inflight:
+            return
+        when = max(self._bucket(chat_id, now).ready_at(now), self._paused.get(chat_id, now))
+        heapq.heappush(self._heap, (when, next(self._tiebreak), chat_id))
+        self._scheduled.add(chat_id)
+        self._wake.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if not self._heap:
+                if not self._inflight:
+                    self._idle.set()
+                    self._sweep(now)
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            when = max(self._heap[0][0], self._global.ready_at(now))
+            if when > now:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), when - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, chat_id = heapq.heappop(self._heap)
+            self._scheduled.discard(chat_id)
+            self._bucket(chat_id, now).take(now)
+            self._global.take(now)
+            self._paused.pop(chat_id, None)
+            msg = self._next(chat_id)
+            self._inflight.add(chat_id)
+            asyncio.create_task(self._deliver(chat_id, msg))
+
+    def _next(self, chat_id):
+        queue = self._queues[chat_id]
+        msg = queue.popleft()
+        while queue and msg.absorb(queue[0]):
+            queue.popleft()
+            METRICS.inc("bot_outbox_coalesced_total")
+        return msg
+
+    async def _deliver(self, chat_id, msg):
+        loop = asyncio.get_running_loop()
+        try:
+            if msg.document is not None:
+                await self.bot.send_document(chat_id, msg.document, caption=msg.text or None, reply_markup=msg.markup,
+                                             message_thread_id=msg.thread)
+            else:
+                await self.bot.send_message(chat_id, msg.text, reply_markup=msg.markup, message_thread_id=msg.thread)
+            METRICS.inc("bot_outbox_sent_total")
+            METRICS.observe("bot_outbox_delay_seconds", loop.time() - msg.queued)
+        except RetryAfter as e:
+            METRICS.inc("bot_outbox_retries_total", reason="429")
+            self._queues[chat_id].appendleft(msg)
+            self._paused[chat_id] = loop.time() + float(e.retry_after)
+        except BadRequest as e:
+            # a NetworkError subclass, but sending it again gets the same answer
+            METRICS.inc("bot_outbox_dropped_total")
+            print("Send error:", e)
+        except NetworkError as e:
+            msg.attempts += 1
+            if msg.attempts < self.max_attempts:
+                METRICS.inc("bot_outbox_retries_total", reason="network")
+                self._queues[chat_id].appendleft(msg)
+                self._paused[chat_id] = loop.time() + min(30, 2 ** msg.attempts)
+            else:
+                METRICS.inc("bot_outbox_dropped_total")
+                print("Send error:", e)
+        except TelegramError as e:
+            # e.g. the bot was removed from the chat; retrying will not help
+            METRICS.inc("bot_outbox_dropped_total")
+            print("Send error:", e)
+        finally:
+            self._inflight.discard(chat_id)
+            if self._queues.get(chat_id):
+                self._schedule(chat_id, loop.time())
+            else:
+                self._queues.pop(chat_id, None)
+            self._wake.set()
+
+    def _sweep(self, now):
+        # a full bucket is the same as a new one, so idle chats need not be kept
+        for chat_id in [c for c, b in self._buckets.items() if c not in self._queues and b.full(now)]:
+            del self._buckets[chat_id]
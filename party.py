@@ -0,0 +1,566 @@
+# party.py
+from array import array
+from itertools import count
+from functools import lru_cache
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from decimal import Decimal, DecimalException, ROUND_HALF_UP
+
+import settlement
+from settlement import min_transfers, settle
+
+# ---------------- money ----------------
+# Amounts are integer cents everywhere; floats only exist at the JSON edge.
+
+def to_cents(amount):
+    # JSON amounts carry at most two decimals, so this is exact
+    return round(amount * 100)
+
+def from_cents(cents):
+    return cents / 100
+
+# amounts are stored as int64 cents; no one expense comes near this
+MAX_CENTS = 10**15
+
+def parse_amount(text):
+    """'25.50' / '25,5' -> 2550; ValueError for anything else, negative or over MAX_CENTS."""
+    try:
+        d = Decimal(text.replace(",", ".").strip())
+        if not d.is_finite() or d < 0 or d * 100 > MAX_CENTS:
+            raise ValueError(text)
+        return int(d.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP) * 100)
+    except DecimalException:
+        raise ValueError(text)
+
+def money(cents, signed=False):
+    sign = "-" if cents < 0 else ("+" if signed else "")
+    units, rest = divmod(abs(cents), 100)
+    return f"{sign}{units}.{rest:02d}"
+
+# ---------------- splits ----------------
+# An expense without a split is shared evenly by all members. A split is a
+# list of parts, [(cents, [(name, weight), ...]), ...], whose cents add up to
+# the expense: one part for a weighted split, one per item of an itemized
+# bill. A part with no names is shared by everybody. Weights are integer
+# hundredths, so 1.5 is 150. Ops and SQLite store parts as
+# {"cents", "weights"}, data.json as {"amount", "weights"}.
+
+# a weight is a ratio between people; nobody's share is a million times anyone else's
+MAX_WEIGHT = 10**6
+
+def weight_units(w):
+    return round(w * 100)
+
+def parse_weight(text):
+    """'2' / '1,5' -> 200 / 150; ValueError unless it is above zero and at most MAX_WEIGHT."""
+    try:
+        d = Decimal(text.replace(",", "."))
+        if not d.is_finite() or d > MAX_WEIGHT:
+            raise ValueError(text)
+        units = weight_units(d)
+    except DecimalException:
+        raise ValueError(text)
+    if units <= 0:
+        raise ValueError(text)
+    return units
+
+def weight_value(units):
+    q, r = divmod(units, 100)
+    return units / 100 if r else q
+
+def split_from_ops(parts):
+    return [(p["cents"], [(u, weight_units(w)) for u, w in p["weights"].items()]) for p in parts]
+
+def split_to_ops(parts):
+    return [{"cents": c, "weights": {u: weight_value(w) for u, w in who}} for c, who in parts]
+
+def split_from_json(parts):
+    return [(to_cents(p["amount"]), [(u, weight_units(w)) for u, w in p["weights"].items()]) for p in parts]
+
+def split_to_json(parts):
+    return [{"amount": from_cents(c), "weights": {u: weight_value(w) for u, w in who}} for c, who in parts]
+
+def split_text(parts):
+    """The split as a payer would type it: "ann bob:2", or "12.50 ann; 7.00 bob" for items."""
+    def names(who):
+        return " ".join(u if w == 100 else f"{u}:{weight_value(w)}" for u, w in who)
+    if len(parts) == 1:
+        return names(parts[0][1])
+    return "; ".join(f"{money(c)} {names(who)}".rstrip() for c, who in parts)
+
+def allocate(cents, weights):
+    """Split ``cents`` in proportion to ``weights``; the shares add up to ``cents`` exactly."""
+    total = sum(weights)
+    shares = [cents * w // total for w in weights]
+    # the leftover cents go to the biggest remainders, earlier names first on ties
+    rest = sorted(range(len(weights)), key=lambda i: -(cents * weights[i] % total))
+    for i in rest[:cents - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+def parse_bill(text):
+    """What a payer types for an expense -> (cents, split or None).
+
+    "25.50" is shared evenly by everybody. "25.50 ann bob:2" is shared by ann
+    and bob, bob's part twice ann's. Several lines are the items of one bill,
+    "<amount> [names]" each. ValueError for anything else.
+    """
+    lines = [line.split() for line in text.splitlines() if line.strip()]
+    if not lines:
+        raise ValueError(text)
+    parts = []
+    for words in lines:
+        who = {}
+        for word in words[1:]:
+            name, _, w = word.replace("@", "").partition(":")
+            if not name:
+                raise ValueError(word)
+            who[name] = parse_weight(w) if w else 100
+        parts.append((parse_amount(words[0]), list(who.items())))
+    cents = sum(c for c, _ in parts)
+    if cents > MAX_CENTS:
+        raise ValueError(text)
+    if len(parts) == 1 and not parts[0][1]:
+        return cents, None
+    return cents, parts
+
+# ---------------- versions ----------------
+# Every change stamps a number from one process-wide counter, so a version is
+# never reused, not even by a chat that was evicted and loaded again.
+_versions = count(1)
+
+def next_version():
+    return next(_versions)
+
+# ---------------- expenses ----------------
+EPOCH = datetime(1970, 1, 1)
+NO_TS = -(2**63)
+NO_DESC = -1
+
+def ts_to_micros(ts):
+    delta = datetime.fromisoformat(ts).replace(tzinfo=None) - EPOCH
+    return delta // timedelta(microseconds=1)
+
+def micros_to_ts(micros):
+    return (EPOCH + timedelta(microseconds=micros)).isoformat()
+
+class Expenses:
+    """Column store for a party's expenses.
+
+    One row is an int64 amount in cents, an int64 UTC timestamp in
+    microseconds, and indexes into interned payer and description tables.
+    Splits live in columns of their own: one entry per part, its cents and
+    an index into ``groups``, the interned ((name index, weight), ...) sets
+    the parts are shared by; ``_parts`` maps a split row to its parts.
+    Iterating yields rows in the JSON shape ({"user", "amount", "desc",
+    "ts", "split"}, desc/ts/split None when the row has none), so converting
+    to and from data.json is lossless.
+    """
+
+    __slots__ = ("cents", "micros", "payers", "descs", "names", "strings", "part_cents", "part_groups", "groups",
+                 "_name_ids", "_string_ids", "_group_ids", "_raw_ts", "_parts")
+
+    def __init__(self):
+        self.cents = array("q")
+        self.micros = array("q")
+        self.payers = array("i")
+        self.descs = array("i")
+        self.names = []
+        self.strings = []
+        self.part_cents = array("q")
+        self.part_groups = array("i")
+        self.groups = []
+        self._name_ids = {}
+        self._string_ids = {}
+        self._group_ids = {}
+        self._raw_ts = {}  # row -> ts text that does not survive the round trip
+        self._parts = {}  # row -> range of its parts
+
+    def __len__(self):
+        return len(self.cents)
+
+    def _intern(self, table, ids, value):
+        i = ids.get(value)
+        if i is None:
+            i = ids[value] = len(table)
+            table.append(value)
+        return i
+
+    def append(self, user, cents, desc=None, ts=None, split=None):
+        row = len(self.cents)
+        self.cents.append(cents)
+        self.payers.append(self._intern(self.names, self._name_ids, user))
+        self.descs.append(NO_DESC if desc is None else self._intern(self.strings, self._string_ids, desc))
+        micros = NO_TS
+        if ts is not None:
+            try:
+                micros = ts_to_micros(ts)
+            except ValueError:
+                pass
+            if micros == NO_TS or micros_to_ts(micros) != ts:
+                self._raw_ts[row] = ts
+        self.micros.append(micros)
+        if split:
+            first = len(self.part_cents)
+            for c, who in split:
+                group = tuple((self._intern(self.names, self._name_ids, u), w) for u, w in who)
+                self.part_cents.append(c)
+                self.part_groups.append(self._intern(self.groups, self._group_ids, group))
+            self._parts[row] = range(first, len(self.part_cents))
+
+    def user(self, row):
+        return self.names[self.payers[row]]
+
+    def desc(self, row):
+        d = self.descs[row]
+        return None if d == NO_DESC else self.strings[d]
+
+    def ts(self, row):
+        raw = self._raw_ts.get(row)
+        if raw is not None:
+            return raw
+        m = self.micros[row]
+        return None if m == NO_TS else micros_to_ts(m)
+
+    def parts(self, row):
+        """The range of ``row``'s parts, None for an even expense."""
+        return self._parts.get(row)
+
+    def split_parts(self):
+        """(row, range of its parts) for every split row, in row order."""
+        return self._parts.items()
+
+    def split(self, row):
+        parts = self._parts.get(row)
+        if parts is None:
+            return None
+        names = self.names
+        return [(self.part_cents[p], [(names[i], w) for i, w in self.groups[self.part_groups[p]]]) for p in parts]
+
+    def row(self, row):
+        split = self.split(row)
+        return {"user": self.user(row), "amount": from_cents(self.cents[row]), "desc": self.desc(row), "ts": self.ts(row),
+                "split": split_to_json(split) if split else None}
+
+    def __iter__(self):
+        for row in range(len(self.cents)):
+            yield self.row(row)
+
+# ---------------- rollups ----------------
+DAY = 86_400_000_000  # microseconds
+
+@lru_cache(maxsize=4096)
+def _month_of_day(day):
+    return (EPOCH + timedelta(days=day)).strftime("%Y-%m")
+
+def month_of(micros):
+    """"YYYY-MM" (UTC) of an expense timestamp, None for an undated one."""
+    return None if micros == NO_TS else _month_of_day(micros // DAY)
+
+class Rollup:
+    """Cents spent and expense counts by month and member, kept as expenses come in.
+
+    ``months[month][member]`` is [cents, expenses]; month None is all time and
+    member None is everybody, so any total is one lookup. Undated expenses
+    only count towards all time.
+    """
+
+    __slots__ = ("months",)
+
+    def __init__(self):
+        self.months = {}
+
+    def add(self, member, month, cents):
+        for mo in (None,) if month is None else (None, month):
+            row = self.months.get(mo)
+            if row is None:
+                row = self.months[mo] = {}
+            for who in (None, member):
+                cell = row.get(who)
+                if cell is None:
+                    row[who] = [cents, 1]
+                else:
+                    cell[0] += cents
+                    cell[1] += 1
+
+    def subtract(self, other):
+        for mo, theirs in other.months.items():
+            row = self.months[mo]
+            for who, (cents, n) in theirs.items():
+                cell = row[who]
+                cell[0] -= cents
+                cell[1] -= n
+                if not cell[1]:
+                    del row[who]
+            if not row:
+                del self.months[mo]
+
+    def get(self, member=None, month=None):
+        """(cents, expenses) for ``member`` in ``month``; None means everybody / all time."""
+        cell = self.months.get(month, {}).get(member)
+        return (cell[0], cell[1]) if cell else (0, 0)
+
+    def members(self, month=None):
+        return [who for who in self.months.get(month, ()) if who is not None]
+
+    def history(self, member=None):
+        """[(month, cents, expenses)] for the months ``member`` spent in, oldest first."""
+        return sorted((mo, *row[member]) for mo, row in self.months.items() if mo is not None and member in row)
+
+# ---------------- party ----------------
+class Party:
+    """One party's members and expenses, with balances kept up to date.
+
+    Member totals are always the sum of that member's expenses: every change
+    goes through ``add_expense``/``add_member``/``remove_member``, which adjust
+    the running total and a list of members ranked by what they paid.
+    ``settlements`` finds the fewest transfers (settlement.py) for up to
+    settlement.MAX_EXACT members with a balance. Bigger groups are paired
+    greedily; the fair share differs between members by at most a cent, so
+    the ranking is already the creditor/debtor order and needs no sort. The
+    result is cached until the next change. All amounts are integer cents.
+
+    Even expenses make one pool that every member pays an equal share of.
+    A split expense is charged to the members among its names, by weight;
+    a part that names no current member goes to the pool. A member's share
+    is their part of the pool plus what they owe for split expenses. Parts
+    shared by the same members with the same weights are added up and
+    shared out together, so the work is per name set, not per expense, and
+    rounding costs at most a cent per set. The sums are rebuilt in one pass
+    over the split columns after a membership change and kept up to date by
+    ``add_expense`` in between.
+
+    Every expense is also added to the party's ``rollup`` and to
+    ``chat_rollup``, the one its chat shares across parties.
+    """
+
+    __slots__ = ("creator", "members", "expenses", "paid", "total", "even_paid", "even_total", "version", "rollup",
+                 "_chat_rollup", "_ranked", "_sets", "_owed", "_settled")
+
+    def __init__(self, creator=None, chat_rollup=None):
+        self.creator = creator
+        self.members = {}  # name -> cents paid, in join order
+        self.expenses = Expenses()
+        self.paid = {}  # name -> cents paid, including people no longer members
+        self.total = 0  # paid by current members
+        self.even_paid = {}  # name -> cents paid for even expenses
+        self.even_total = 0  # even expenses paid by current members
+        self.version = next_version()
+        self.rollup = Rollup()
+        self._chat_rollup = chat_rollup
+        self._ranked = []  # (paid, name) for members, ascending
+        self._sets = None  # name set of members -> cents of split parts; None until worked out
+        self._owed = {}  # name index -> cents owed for split expenses
+        self._settled = None
+
+    @classmethod
+    def from_json(cls, raw, chat_rollup=None):
+        # raw is in the current schema (see schema.py); totals and rollups are recomputed from the expenses
+        party = cls(raw["creator"], chat_rollup)
+        for name in raw["members"]:
+            party.add_member(name)
+        for e in raw["expenses"]:
+            split = split_from_json(e["split"]) if e["split"] else None
+            party.add_expense(e["user"], to_cents(e["amount"]), e["desc"], e["ts"], join=False, split=split)
+        return party
+
+    def to_json(self):
+        return {
+            "creator": self.creator,
+            "members": {name: from_cents(c) for name, c in self.members.items()},
+            "expenses": list(self.expenses),
+        }
+
+    def _touch(self):
+        self.version = next_version()
+        self._settled = None
+
+    def _rerank(self, name, old, new):
+        del self._ranked[bisect_left(self._ranked, (old, name))]
+        insort(self._ranked, (new, name))
+
+    def add_member(self, name):
+        if name in self.members:
+            return
+        p = self.paid.get(name, 0)
+        self.members[name] = p
+        self.total += p
+        self.even_total += self.even_paid.get(name, 0)
+        insort(self._ranked, (p, name))
+        self._sets = None
+        self._touch()
+
+    def remove_member(self, name):
+        # their expenses stay in the history and come back if they rejoin
+        p = self.members.pop(name)
+        self.total -= p
+        self.even_total -= self.even_paid.get(name, 0)
+        del self._ranked[bisect_left(self._ranked, (p, name))]
+        self._sets = None
+        self._touch()
+
+    def add_expense(self, user, cents, desc=None, ts=None, join=True, split=None):
+        # with join the payer becomes a member if they are not one yet
+        self.expenses.append(user, cents, desc, ts, split)
+        month = month_of(self.expenses.micros[-1])
+        self.rollup.add(user, month, cents)
+        if self._chat_rollup is not None:
+            self._chat_rollup.add(user, month, cents)
+        if join:
+            self.add_member(user)
+        old = self.paid.get(user, 0)
+        new = self.paid[user] = old + cents
+        if not split:
+            self.even_paid[user] = self.even_paid.get(user, 0) + cents
+        if user in self.members:
+            self.members[user] = new
+            self.total += cents
+            self._rerank(user, old, new)
+            if not split:
+                self.even_total += cents
+            elif self._sets is not None:
+                ex = self.expenses
+                names, members = ex.names, self.members
+                for p in ex.parts(len(ex) - 1):
+                    group = tuple(x for x in ex.groups[ex.part_groups[p]] if names[x[0]] in members)
+                    self._add_to_set(group, ex.part_cents[p])
+        self._touch()
+
+    def _charge(self, group, cents, sign):
+        owed = self._owed
+        for (i, _), c in zip(group, allocate(cents, [w for _, w in group])):
+            owed[i] = owed.get(i, 0) + sign * c
+
+    def _add_to_set(self, group, cents):
+        old = self._sets.get(group, 0)
+        self._sets[group] = old + cents
+        if group:
+            # re-share the set's new total; the old one comes off first
+            if old:
+                self._charge(group, old, -1)
+            self._charge(group, old + cents, 1)
+
+    def _weighted(self):
+        """(cents owed by name index, pool cents) for the split expenses paid by members."""
+        if self._sets is None and not self.expenses.groups:
+            self._sets = {}  # no split expenses at all
+        if self._sets is None:
+            ex = self.expenses
+            member = [u in self.members for u in ex.names]
+            totals = [0] * len(ex.groups)
+            cents, groups, payers = ex.part_cents, ex.part_groups, ex.payers
+            for row, parts in ex.split_parts():
+                if member[payers[row]]:
+                    for p in parts:
+                        totals[groups[p]] += cents[p]
+            # sets that differ only in non-members become one
+            self._sets, self._owed = {}, {}
+            for g, c in enumerate(totals):
+                if c:
+                    self._add_to_set(tuple(x for x in ex.groups[g] if member[x[0]]), c)
+        return self._owed, self._sets.get((), 0)
+
+    @property
+    def average(self):
+        # for display only, rounded half up; shares() is what settles
+        n = len(self.members)
+        return (2 * self.total + n) // (2 * n) if n else 0
+
+    def shares(self):
+        """Each member's fair share; the pool's leftover cents go to the earliest members."""
+        n = len(self.members)
+        if not n:
+            return {}
+        owed, pool = self._weighted()
+        q, r = divmod(self.even_total + pool, n)
+        shares = {u: q + (i < r) for i, u in enumerate(self.members)}
+        names = self.expenses.names
+        for i, c in owed.items():
+            shares[names[i]] += c
+        return shares
+
+    def _greedy_sides(self, balances):
+        if self._sets:
+            # split expenses: what someone paid no longer orders the balances
+            debtors = sorted(((u, -b) for u, b in balances.items() if b < 0), key=lambda x: -x[1])
+            creditors = sorted(((u, b) for u, b in balances.items() if b > 0), key=lambda x: -x[1])
+            return debtors, creditors
+        # shares are q or q+1, so only paid > q can be owed and only paid <= q can owe
+        q = self.total // len(self.members) if self.members else 0
+        creditors = []
+        for p, u in reversed(self._ranked):
+            if p <= q:
+                break
+            if balances[u] > 0:
+                creditors.append((u, balances[u]))
+        debtors = []
+        for p, u in self._ranked:
+            if p > q:
+                break
+            if balances[u] < 0:
+                debtors.append((u, -balances[u]))
+        return debtors, creditors
+
+    def settlements(self):
+        """(average, balances, transfers) for the current state, in cents."""
+        if self._settled is None:
+            shares = self.shares()
+            balances = {u: p - shares[u] for u, p in self.members.items()}
+            owed = [(b, u) for u, b in balances.items() if b]
+            if len(owed) <= settlement.MAX_EXACT:
+                # fewest transfers; cached by the sorted balances, so names map by position
+                owed.sort()
+                names = [u for _, u in owed]
+                debts = [(names[d], names[c], a) for d, c, a in min_transfers(tuple(b for b, _ in owed))]
+            else:
+                debts = settle(*self._greedy_sides(balances))
+            self._settled = (self.average, balances, debts)
+        return self._settled
+
+# ---------------- chat ----------------
+class Chat:
+    """A chat's language, its parties by name and the selected one.
+
+    ``version`` changes whenever the set of parties does; it is not persisted.
+    Neither is ``rollup``, the spending of all its parties together: loading
+    the chat adds every stored expense to it again.
+    """
+
+    __slots__ = ("lang", "current", "parties", "version", "rollup")
+
+    def __init__(self, lang="ua", current=None):
+        self.lang = lang
+        self.current = current
+        self.parties = {}
+        self.version = next_version()
+        self.rollup = Rollup()
+
+    @classmethod
+    def from_json(cls, raw):
+        chat = cls(raw["lang"], raw["current"])
+        for name, p in raw["parties"].items():
+            chat.parties[name] = Party.from_json(p, chat.rollup)
+        return chat
+
+    def to_json(self):
+        return {
+            "lang": self.lang,
+            "parties": {name: p.to_json() for name, p in self.parties.items()},
+            "current": self.current,
+        }
+
+    def party(self, name, creator=None):
+        """The party called ``name``, created if there is none."""
+        party = self.parties.get(name)
+        if party is None:
+            party = self.parties[name] = Party(creator, self.rollup)
+            self.version = next_version()
+        return party
+
+    def delete_party(self, name):
+        party = self.parties.pop(name, None)
+        if party is not None:
+            self.rollup.subtract(party.rollup)
+        self.version = next_version()
+        if self.current == name:
+            self.current = None
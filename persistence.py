@@ -0,0 +1,112 @@
+# persistence.py
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from storage import Conversation
+
+# the user_data keys a conversation is made of; anything else is not kept
+STATE, AMOUNT, SPLIT = "state", "pending_amount", "pending_split"
+
+class StorePersistence(BasePersistence):
+    """Keeps each user's place in a multi-step action in the bot's own storage.
+
+    Only user_data is persisted, and of it only the step and what was typed
+    so far, as one Conversation record per user who is mid-action; a user at
+    the menu has none. PTB hands over the users touched since its last run
+    every ``update_interval`` seconds, and a record is written only when it
+    differs from the stored one, through the storage writer like any op.
+    A conversation left untouched for ``ttl`` seconds is dropped, at startup
+    or when the user comes back, and they start again from the menu.
+    ``states`` is the Enum the step is stored as.
+    """
+
+    def __init__(self, store, states, ttl=86400.0, update_interval=1.0):
+        super().__init__(PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval)
+        self.store = store
+        self.states = states
+        self.ttl = ttl
+
+    def _expired(self, record, now):
+        return now - record.at > self.ttl
+
+    async def get_user_data(self):
+        now = time.time()
+        user_data = {}
+        for user_id, record in list(self.store.conversations.items()):
+            try:
+                state = self.states(record.state)
+            except ValueError:
+                state = None  # a step this version of the bot does not have
+            if state is None or self._expired(record, now):
+                self.store.keep_conversation(user_id, None)
+                continue
+            data = user_data[int(user_id)] = {STATE: state}
+            if record.amount is not None:
+                data[AMOUNT] = record.amount
+            if record.split is not None:
+                data[SPLIT] = record.split
+        return user_data
+
+    async def update_user_data(self, user_id, data):
+        state = data.get(STATE)
+        amount, split = data.get(AMOUNT), data.get(SPLIT)
+        old = self.store.conversations.get(str(user_id))
+        if (state is None or state is self.states.MENU) and amount is None and split is None:
+            if old is not None:
+                self.store.keep_conversation(user_id, None)
+            return
+        value = state.value if state is not None else self.states.MENU.value
+        if old is not None and (old.state, old.amount, old.split) == (value, amount, split):
+            return
+        self.store.keep_conversation(user_id, Conversation(value, amount, split, time.time()))
+
+    async def refresh_user_data(self, user_id, user_data):
+        # runs before every handler; a stale conversation is forgotten before it is resumed
+        record = self.store.conversations.get(str(user_id))
+        if record is not None and self._expired(record, time.time()):
+            for key in (STATE, AMOUNT, SPLIT):
+                user_data.pop(key, None)
+            self.store.keep_conversation(user_id, None)
+
+    async def drop_user_data(self, user_id):
+        if str(user_id) in self.store.conversations:
+            self.store.keep_conversation(user_id, None)
+
+    async def flush(self):
+        self.store.flush()
+
+    # ---------------- not stored ----------------
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
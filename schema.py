@@ -0,0 +1,206 @@
+# schema.py
+"""Versions of the data file layout, and the migrations between them.
+
+Version 1 is everything written before the file was versioned. It mixes
+shapes:
+- ``members`` is a dict of totals, or a plain list of names as in
+  parties_data.json;
+- ``expenses`` is a list or an empty ``{}``;
+- the selected party is stored as ``current`` or ``current_party``;
+- ``creator``, ``desc`` and ``ts`` may be missing.
+
+Version 2 is the first canonical shape: members as a dict, every expense
+with "desc" and "ts".
+
+Version 3 adds "split" to every expense: null for an even expense, else
+the parts it is shared by (see party.py). Every reader after the migration
+can rely on this shape:
+
+    {"_schema": 3,
+     "<chat id>": {"lang": "ua", "current": "name" | null,
+                   "parties": {"<name>": {"creator": id | null,
+                                          "members": {"<member>": total},
+                                          "expenses": [{"user", "amount", "desc", "ts",
+                                                        "split": [{"amount", "weights": {"<member>": w}}] | null}]}}},
+     "_seq": 17}
+
+Keys starting with "_" are file metadata. Files are read and written one
+chat at a time, so a file never has to fit in memory as a whole.
+
+    python schema.py data.json parties_data.json   # rewrite files in place
+"""
+import os
+import sys
+import json
+
+SCHEMA_VERSION = 3
+SCHEMA_KEY = "_schema"
+
+# ---------------- migrations ----------------
+def _expense_v2(e):
+    # None for rows that cannot be read at all
+    if not isinstance(e, dict) or not e.get("user"):
+        return None
+    try:
+        amount = round(float(e["amount"]), 2)
+    except (KeyError, TypeError, ValueError):
+        return None
+    return {"user": str(e["user"]), "amount": amount, "desc": _text(e.get("desc")), "ts": _text(e.get("ts"))}
+
+def _text(value):
+    # hand-edited files may have numbers here, e.g. a unix time as "ts"
+    return None if value is None else str(value)
+
+def _party_v2(raw):
+    expenses = [e for e in map(_expense_v2, raw.get("expenses") or []) if e is not None]
+    members = raw.get("members") or {}
+    if not isinstance(members, dict):
+        # a list of names: totals are what each one paid
+        paid = {}
+        for e in expenses:
+            paid[e["user"]] = paid.get(e["user"], 0) + round(e["amount"] * 100)
+        members = {name: paid.get(name, 0) / 100 for name in members}
+    return {"creator": raw.get("creator"), "members": members, "expenses": expenses}
+
+def v1_to_v2(raw):
+    return {
+        "lang": raw.get("lang") or "ua",
+        "current": raw.get("current") or raw.get("current_party"),
+        "parties": {name: _party_v2(p) for name, p in (raw.get("parties") or {}).items()},
+    }
+
+def v2_to_v3(raw):
+    # everything written before splits was shared evenly
+    for party in raw["parties"].values():
+        for e in party["expenses"]:
+            e["split"] = None
+    return raw
+
+# version -> function that takes one chat to the next version
+MIGRATIONS = {1: v1_to_v2, 2: v2_to_v3}
+
+def migrate_chat(raw, version):
+    """Bring one chat written as ``version`` up to SCHEMA_VERSION."""
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"data schema {version} is newer than this bot ({SCHEMA_VERSION})")
+    while version < SCHEMA_VERSION:
+        raw = MIGRATIONS[version](raw)
+        version += 1
+    return raw
+
+# ---------------- streaming ----------------
+_decoder = json.JSONDecoder()
+_WS = " \t\n\r"
+_NUMBER = set("0123456789+-.eE") | {""}
+
+def iter_object(f, chunk_size=1 << 16):
+    """Yield (key, value) for each member of the JSON object that makes up the
+    text file ``f``, decoding one member at a time."""
+    buf, pos, eof = "", 0, False
+
+    def more():
+        nonlocal buf, pos, eof
+        # read at least as much as is buffered, so a big value is not re-parsed once per chunk
+        chunk = f.read(max(chunk_size, len(buf) - pos))
+        if not chunk:
+            eof = True
+            return False
+        buf, pos = buf[pos:] + chunk, 0
+        return True
+
+    def skip_ws():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in _WS:
+                pos += 1
+            if pos < len(buf) or not more():
+                return
+
+    def next_char():
+        nonlocal pos
+        skip_ws()
+        if pos >= len(buf):
+            raise ValueError("unexpected end of data")
+        pos += 1
+        return buf[pos - 1]
+
+    def value():
+        nonlocal pos
+        skip_ws()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(buf, pos)
+                # a number is only whole once something else follows it: "1" may be "1.5e3" cut short
+                if eof or not isinstance(obj, (int, float)) or buf[end:end + 1] not in _NUMBER:
+                    pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            more()
+
+    if next_char() != "{":
+        raise ValueError("expected a JSON object")
+    skip_ws()
+    if buf[pos:pos + 1] == "}":
+        return
+    while True:
+        key = value()
+        if next_char() != ":":
+            raise ValueError(f"expected ':' after {key!r}")
+        yield key, value()
+        c = next_char()
+        if c == "}":
+            return
+        if c != ",":
+            raise ValueError(f"expected ',' or '}}' after {key!r}")
+
+def read_chats(path, meta=None):
+    """Yield (chat id, chat in the current schema) from a data file of any version.
+
+    Metadata members are collected into ``meta`` as they go by. Files without
+    "_schema" are version 1.
+    """
+    version = 1
+    with open(path, "r", encoding="utf-8") as f:
+        for key, raw in iter_object(f):
+            if key.startswith("_"):
+                if key == SCHEMA_KEY:
+                    version = raw
+                if meta is not None:
+                    meta[key] = raw
+                continue
+            yield key, migrate_chat(raw, version)
+
+def dump_chats(chats, meta=None):
+    """Yield the text of a current-schema data file, one chat at a time.
+
+    "_schema" goes first, so a reader knows the version before the first
+    chat. The rest of ``meta`` goes last, so it may still be filling up while
+    ``chats`` is consumed.
+    """
+    yield "{\n" + f'  "{SCHEMA_KEY}": {SCHEMA_VERSION}'
+    for chat_id, chat in chats:
+        yield f",\n  {json.dumps(chat_id)}: " + json.dumps(chat, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+    for key, value in (meta or {}).items():
+        if key != SCHEMA_KEY:
+            yield f",\n  {json.dumps(key)}: {json.dumps(value)}"
+    yield "\n}\n"
+
+def migrate_file(path):
+    """Rewrite ``path`` in the current schema, through a temp file."""
+    meta = {}
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as out:
+        out.writelines(dump_chats(read_chats(path, meta), meta))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp, path)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python schema.py DATA_FILE [DATA_FILE ...]")
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        migrate_file(path)
+        print(f"Migrated {path} to schema {SCHEMA_VERSION}")
@@ -0,0 +1,118 @@
+# settlement.py
+import time
+from functools import lru_cache
+
+from metrics import METRICS
+
+# The exact search is O(2^n * n) in the members who owe or are owed. With more
+# of them than MAX_EXACT, or when the search runs past TIME_BUDGET, the
+# greedy pairing is used instead. main.py reads both from the env.
+MAX_EXACT = 14
+TIME_BUDGET = 0.05  # seconds
+CACHE_SIZE = 4096
+
+# ---------------- greedy ----------------
+def settle(debtors, creditors):
+    # debtors/creditors: [(name, cents owed / to receive)], biggest first
+    debtors, creditors = list(debtors), list(creditors)
+    i=j=0
+    debts=[]
+    while i < len(debtors) and j < len(creditors):
+        d_name, d_amt = debtors[i]
+        c_name, c_amt = creditors[j]
+        pay = min(d_amt, c_amt)
+        if pay>0:
+            debts.append((d_name, c_name, pay))
+        debtors[i] = (d_name, d_amt - pay)
+        creditors[j] = (c_name, c_amt - pay)
+        if debtors[i][1] == 0: i += 1
+        if creditors[j][1] == 0: j += 1
+    return debts
+
+def settle_group(indexes, values):
+    """Greedy transfers inside one zero-sum group: at most len(indexes) - 1."""
+    debtors = sorted(((i, -values[i]) for i in indexes if values[i] < 0), key=lambda x: -x[1])
+    creditors = sorted(((i, values[i]) for i in indexes if values[i] > 0), key=lambda x: -x[1])
+    return settle(debtors, creditors)
+
+# ---------------- exact ----------------
+def zero_sum_groups(values, deadline):
+    """Split ``values`` (summing to 0) into as many zero-sum groups as possible.
+
+    Every group of k members settles in k - 1 transfers, so the most groups
+    means the fewest transfers. dp[mask] is the most zero-sum groups that the
+    members in ``mask`` can be split into; each mask is one member added to a
+    smaller one. Returns lists of indexes, or None once ``deadline`` passes.
+    """
+    n = len(values)
+    size = 1 << n
+    sums = [0] * size
+    dp = [0] * size
+    for mask in range(1, size):
+        low = mask & -mask
+        sums[mask] = s = sums[mask ^ low] + values[low.bit_length() - 1]
+        best = 0
+        m = mask
+        while m:
+            b = m & -m
+            if dp[mask ^ b] > best:
+                best = dp[mask ^ b]
+            m ^= b
+        dp[mask] = best + (s == 0)
+        if not mask & 0x3FF and time.perf_counter() > deadline:
+            return None
+    # walk back: the members taken off in reverse order cut into groups where the running sum is 0
+    order = []
+    mask = size - 1
+    while mask:
+        want = dp[mask] - (sums[mask] == 0)
+        m = mask
+        while m:
+            b = m & -m
+            if dp[mask ^ b] == want:
+                break
+            m ^= b
+        order.append(b.bit_length() - 1)
+        mask ^= b
+    groups, group, total = [], [], 0
+    for i in reversed(order):
+        group.append(i)
+        total += values[i]
+        if total == 0:
+            groups.append(group)
+            group = []
+    return groups
+
+@lru_cache(maxsize=CACHE_SIZE)
+def min_transfers(values):
+    """Transfers (from, to, cents) between indexes of ``values``, a sorted
+    tuple of non-zero balances summing to 0.
+
+    Opposite pairs are settled first; they are always part of some optimal
+    answer and shrink the search. The rest is searched exactly when it is
+    small enough and in time, greedily otherwise. Cached per balance vector.
+    """
+    by_value = {}
+    pairs = []
+    for i, v in enumerate(values):
+        match = by_value.get(-v)
+        if match:
+            pairs.append([match.pop(), i])
+        else:
+            by_value.setdefault(v, []).append(i)
+    rest = [i for idxs in by_value.values() for i in idxs]
+    groups = None
+    if len(rest) > MAX_EXACT:
+        METRICS.inc("bot_settle_greedy_total", reason="size")
+    else:
+        found = zero_sum_groups([values[i] for i in rest], time.perf_counter() + TIME_BUDGET)
+        if found is None:
+            METRICS.inc("bot_settle_greedy_total", reason="time")
+        else:
+            groups = [[rest[i] for i in g] for g in found]
+    if groups is None:
+        groups = [rest]
+    debts = []
+    for group in pairs + groups:
+        debts.extend(settle_group(group, values))
+    return debts
@@ -0,0 +1,189 @@
+# shards.py
+import os
+import sys
+import json
+import zlib
+import signal
+import asyncio
+
+from telegram import Update
+
+from storage import JsonStore, SqliteStore, connect, dump_snapshot, sql_insert_chat, write_snapshot
+
+# One update per line on a worker's stdin; Telegram caps a webhook body well below this
+MAX_LINE = 4 * 1024 * 1024
+
+# ---------------- placement ----------------
+def shard_of(chat_id, n):
+    # crc32, not hash(): str hashes are salted per process
+    return zlib.crc32(str(chat_id).encode("utf-8")) % n
+
+def shard_path(path, index, n):
+    """data.json -> data.2of4.json; one worker keeps the plain name."""
+    if n == 1:
+        return path
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{index}of{n}{ext}"
+
+# ---------------- rebalancing ----------------
+def layout_path(path):
+    return path + ".shards"
+
+def read_layout(path):
+    """(workers, previous workers) the files at ``path`` are split for."""
+    try:
+        with open(layout_path(path), "r", encoding="utf-8") as f:
+            layout = json.load(f)
+    except FileNotFoundError:
+        return 1, 1
+    return layout["workers"], layout.get("previous", layout["workers"])
+
+def remove_files(storage, path):
+    if storage == "sqlite":
+        names = [path, path + "-wal", path + "-shm", path + "-journal"]
+    else:
+        journal = path.rsplit(".", 1)[0] + ".journal"
+        names = [path, path + ".tmp", journal, journal + ".old"]
+    for name in names:
+        if os.path.exists(name):
+            os.remove(name)
+
+def rebalance(storage, path, n):
+    """Split the chats stored under ``path`` into ``n`` shard files.
+
+    New files are written next to the old ones, then the layout file is
+    switched and only after that the old files are removed. A crash before the
+    switch leaves the old layout in charge; a crash after it leaves files that
+    the next start removes. Returns how many chats were moved.
+    """
+    workers, previous = read_layout(path)
+    if workers != previous:
+        for i in range(previous):
+            remove_files(storage, shard_path(path, i, previous))
+        write_snapshot(layout_path(path), json.dumps({"workers": workers}))
+    if workers == n:
+        return 0
+    targets = [shard_path(path, i, n) for i in range(n)]
+    for target in targets:
+        remove_files(storage, target)
+    moved = 0
+    if storage == "sqlite":
+        conns = [connect(target) for target in targets]
+        for i in range(workers):
+            store = SqliteStore(shard_path(path, i, workers))
+            store.load()
+            for chat_id, chat in store.chats():
+                sql_insert_chat(conns[shard_of(chat_id, n)], chat_id, chat)
+                moved += 1
+            store.close()
+        for conn in conns:
+            conn.commit()
+            conn.close()
+    else:
+        split = [{} for _ in range(n)]
+        for i in range(workers):
+            store = JsonStore(shard_path(path, i, workers))
+            store.load()
+            for chat_id, chat in store.chats():
+                split[shard_of(chat_id, n)][chat_id] = chat
+                moved += 1
+            store.close()
+        for target, data in zip(targets, split):
+            write_snapshot(target, dump_snapshot(data, 0))
+    write_snapshot(layout_path(path), json.dumps({"workers": n, "previous": workers}))
+    for i in range(workers):
+        remove_files(storage, shard_path(path, i, workers))
+    write_snapshot(layout_path(path), json.dumps({"workers": n}))
+    print(f"Rebalanced {moved} chats from {workers} to {n} shards")
+    return moved
+
+# ---------------- front ----------------
+class ShardRouter:
+    """Runs ``n`` worker processes and hands each update to the one that owns its chat.
+
+    Register ``forward`` as the only handler of a non-concurrent Application:
+    updates then leave in the order they arrived, and each worker's stdin
+    is one ordered stream, so a chat's updates stay in order. When a worker is
+    busy its pipe fills, ``forward`` waits on it, and the wait reaches the
+    webhook limit or the polling loop. ``env`` maps a worker index to extra
+    environment variables for that worker.
+    """
+
+    def __init__(self, n, script, env=None):
+        self.n = n
+        self.script = script
+        self.env = env or {}
+        self.workers = [None] * n
+
+    async def _spawn(self, i):
+        env = dict(os.environ, SHARD_INDEX=str(i), SHARDS=str(self.n), **self.env.get(i, {}))
+        self.workers[i] = await asyncio.create_subprocess_exec(sys.executable, self.script, stdin=asyncio.subprocess.PIPE,
+                                                               env=env)
+
+    async def start(self, app=None):
+        for i in range(self.n):
+            await self._spawn(i)
+
+    async def forward(self, update, context=None):
+        chat = update.effective_chat
+        # updates without a chat are not handled by anyone; worker 0 takes them anyway
+        i = shard_of(chat.id, self.n) if chat else 0
+        line = (json.dumps(update.to_dict(), ensure_ascii=False) + "\n").encode("utf-8")
+        for attempt in range(2):
+            worker = self.workers[i]
+            if worker.returncode is not None:
+                print(f"Worker {i} exited with {worker.returncode}, restarting")
+                await self._spawn(i)
+                worker = self.workers[i]
+            try:
+                worker.stdin.write(line)
+                await worker.stdin.drain()
+                return
+            except (BrokenPipeError, ConnectionResetError):
+                await worker.wait()
+
+    async def stop(self, app=None):
+        # EOF tells a worker to finish what it has, flush its storage and exit
+        for worker in self.workers:
+            if worker is not None and worker.returncode is None:
+                worker.stdin.close()
+        for worker in self.workers:
+            if worker is not None:
+                await worker.wait()
+
+# ---------------- worker ----------------
+async def run_worker(app, limit=1000):
+    """Handle the updates the front writes to stdin until it closes the pipe.
+
+    At most ``limit`` updates are read ahead of the ones still being handled.
+    """
+    # the front decides when workers stop; Ctrl+C reaches the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=MAX_LINE)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    slots = asyncio.Semaphore(limit)
+
+    async def process(update):
+        try:
+            await app.update_processor.process_update(update, app.process_update(update))
+        finally:
+            slots.release()
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    try:
+        while line := await reader.readline():
+            await slots.acquire()
+            update = Update.de_json(json.loads(line), app.bot)
+            app.create_task(process(update), update=update)
+    finally:
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
@@ -0,0 +1,577 @@
+# storage.py
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+from collections import Counter, OrderedDict, namedtuple
+from party import Chat, Party, split_from_ops, split_to_ops, to_cents
+from schema import dump_chats, read_chats
+
+# ---------------- ops ----------------
+# Every change to the bot state is a small op dict. The same function applies
+# it live and when replaying the journal, so both paths can never disagree.
+
+def apply_op(chat, op):
+    kind = op["op"]
+    if kind == "lang":
+        chat.lang = op["lang"]
+    elif kind == "party_create":
+        chat.party(op["name"], op["creator"]).add_member(op["member"])
+        chat.current = op["name"]
+    elif kind == "select":
+        chat.current = op["name"]
+    elif kind == "expense":
+        # journals written before amounts were in cents carry a float "amount"
+        cents = op["cents"] if "cents" in op else to_cents(op["amount"])
+        split = split_from_ops(op["split"]) if op.get("split") else None
+        chat.party(op["party"]).add_expense(op["user"], cents, op["desc"], op["ts"], split=split)
+    elif kind == "member_add":
+        chat.party(op["party"]).add_member(op["name"])
+    elif kind == "member_remove":
+        party = chat.parties.get(op["party"])
+        if party is not None and op["name"] in party.members:
+            party.remove_member(op["name"])
+    elif kind == "party_delete":
+        chat.delete_party(op["name"])
+    else:
+        raise ValueError(f"unknown op: {kind}")
+
+# ---------------- conversations ----------------
+# Where a user is in a multi-step action (persistence.py), one small record
+# per user who is mid-action: the State value, the amount and split typed so
+# far, and when it last changed. They go through the writer like chat ops.
+Conversation = namedtuple("Conversation", "state amount split at")
+
+def apply_conversation(conversations, op):
+    if op["state"] is None:
+        conversations.pop(op["user"], None)
+    else:
+        conversations[op["user"]] = Conversation(op["state"], op["amount"], op["split"], op["at"])
+
+# ---------------- base ----------------
+class Storage:
+    """Chat state plus a writer thread that persists ops in the background.
+
+    ``chat`` returns the live dict for a chat (created on first use). ``commit``
+    applies an op to it and queues the op; nothing touches the disk on the
+    caller's thread. The writer collects whatever arrived within ``max_lag``
+    seconds and hands it to ``_write`` in one batch, so ``max_lag`` is the most
+    work a crash can lose. Subclasses implement ``load``, ``chat`` and ``_write``
+    (which returns the bytes it wrote, if it knows). ``on_write``, when set, is
+    called from the writer thread as ``on_write(seconds, ops, nbytes)``.
+    ``conversations`` holds the Conversation records by user id; ``load``
+    fills it and ``keep_conversation`` changes it.
+
+    A failed write is retried every ``max_lag`` seconds for as long as the bot
+    runs; once it has failed ``write_retries`` times in a row, ``flush`` stops
+    waiting for it and ``close`` gives up and drops what is still queued.
+    """
+
+    write_retries = 5
+
+    def __init__(self, max_lag=1.0):
+        self.max_lag = max_lag
+        self.seq = 0
+        self._written = 0
+        self._pending = []
+        self._unwritten = Counter()  # chat id -> ops still queued
+        self._flush_requested = False
+        self._stopping = False
+        self._failures = 0  # writes failed in a row
+        self._cond = threading.Condition()
+        self._writer = None
+        self.on_write = None
+        self.conversations = {}
+
+    def load(self):
+        raise NotImplementedError
+
+    def chat(self, chat_id):
+        raise NotImplementedError
+
+    def loaded(self):
+        """The chats currently held in memory, by chat id."""
+        raise NotImplementedError
+
+    def chats(self):
+        """Every stored chat as (chat id, chat), whether in memory or not."""
+        raise NotImplementedError
+
+    def _write(self, batch):
+        raise NotImplementedError
+
+    def start(self):
+        self._written = self.seq
+        self._writer = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+        self._writer.start()
+
+    def commit(self, op):
+        apply_op(self.chat(op["chat"]), op)
+        self._queue(op)
+
+    def keep_conversation(self, user_id, record):
+        """Store ``record`` (a Conversation) for ``user_id``; None forgets it."""
+        op = {"op": "conversation", "user": str(user_id), **(record._asdict() if record else {"state": None})}
+        apply_conversation(self.conversations, op)
+        self._queue(op)
+
+    def _queue(self, op):
+        with self._cond:
+            self.seq += 1
+            self._pending.append((self.seq, op))
+            if "chat" in op:
+                self._unwritten[op["chat"]] += 1
+            if len(self._pending) == 1:
+                self._cond.notify_all()
+
+    def is_dirty(self, chat_id):
+        with self._cond:
+            return self._unwritten[str(chat_id)] > 0
+
+    def flush(self):
+        """Block until everything committed so far is on disk."""
+        with self._cond:
+            target = self.seq
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._written < target and self._writer.is_alive() and self._failures < self.write_retries:
+                self._cond.wait()
+
+    def close(self):
+        if self._writer is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._writer = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                # give a burst up to max_lag to pile up, then write it in one go
+                deadline = time.monotonic() + self.max_lag
+                while not (self._stopping or self._flush_requested):
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+                batch, self._pending = self._pending, []
+                self._flush_requested = False
+                stopping = self._stopping
+            if batch:
+                try:
+                    t0 = time.perf_counter()
+                    nbytes = self._write(batch)
+                    if self.on_write is not None:
+                        self.on_write(time.perf_counter() - t0, len(batch), nbytes or 0)
+                except (OSError, sqlite3.Error) as e:
+                    print("Persist error:", e)
+                    with self._cond:
+                        self._pending[:0] = batch
+                        self._failures += 1
+                        self._cond.notify_all()
+                        if self._stopping and self._failures >= self.write_retries:
+                            print("Persist error: giving up,", len(self._pending), "ops not written")
+                            return
+                    time.sleep(self.max_lag)
+                    continue
+            with self._cond:
+                if batch:
+                    self._failures = 0
+                    self._written = batch[-1][0]
+                    self._unwritten.subtract(op["chat"] for _, op in batch if "chat" in op)
+                    self._unwritten += Counter()  # drop zero counts
+                self._cond.notify_all()
+                if stopping and not self._pending:
+                    return
+
+# ---------------- JSON snapshot + journal ----------------
+SEQ_KEY = "_seq"
+CONVERSATIONS_KEY = "_conversations"
+
+def read_snapshot(path, conversations=None):
+    # any schema version, migrated one chat at a time as it is read
+    if os.path.exists(path):
+        meta = {}
+        data = {chat_id: Chat.from_json(raw) for chat_id, raw in read_chats(path, meta)}
+        if conversations is not None:
+            conversations.update((u, Conversation(*r)) for u, r in meta.get(CONVERSATIONS_KEY, {}).items())
+        return data, meta.get(SEQ_KEY, 0)
+    return {}, 0
+
+def dump_snapshot(data, seq, conversations=None):
+    meta = {SEQ_KEY: seq}
+    if conversations:
+        meta[CONVERSATIONS_KEY] = conversations
+    return dump_chats(((chat_id, chat.to_json()) for chat_id, chat in data.items()), meta)
+
+def write_snapshot(path, text):
+    """Write ``text`` (a string or an iterable of strings) to a temp file and
+    swap it in, so a crash never leaves half a file."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        if isinstance(text, str):
+            f.write(text)
+        else:
+            f.writelines(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def read_journal(path):
+    """Return (records, valid_bytes); stops at a torn trailing record."""
+    records, end = [], 0
+    if not os.path.exists(path):
+        return records, end
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError
+                records.append(json.loads(line))
+            except ValueError:
+                # a crash mid-append leaves a partial last line; nothing after it was acknowledged
+                break
+            end += len(line)
+    return records, end
+
+def replay(data, records, seq, conversations=None):
+    for rec in records:
+        if rec["seq"] > seq:
+            op = rec["op"]
+            if op["op"] == "conversation":
+                if conversations is not None:
+                    apply_conversation(conversations, op)
+            else:
+                chat = data.get(op["chat"])
+                if chat is None:
+                    chat = data[op["chat"]] = Chat()
+                apply_op(chat, op)
+            seq = rec["seq"]
+    return seq
+
+def compact_segment(path, segment):
+    """Fold a journal segment into the snapshot at ``path`` and drop the segment."""
+    conversations = {}
+    data, seq = read_snapshot(path, conversations)
+    records, _ = read_journal(segment)
+    seq = replay(data, records, seq, conversations)
+    write_snapshot(path, dump_snapshot(data, seq, conversations))
+    os.remove(segment)
+
+class JsonStore(Storage):
+    """Snapshot (data.json) plus an append-only journal of ops.
+
+    Every chat is held in memory. Each batch is appended to the journal with
+    one write and one fsync; once the journal grows past ``compact_every``
+    records the segment is rotated out and folded into a fresh snapshot on a
+    compactor thread. Conversation records ride along in the journal and
+    under "_conversations" in the snapshot.
+    """
+
+    def __init__(self, path, max_lag=1.0, compact_every=1000):
+        super().__init__(max_lag)
+        self.path = path
+        self.journal_path = path.rsplit(".", 1)[0] + ".journal"
+        self.old_journal_path = self.journal_path + ".old"
+        self.compact_every = compact_every
+        self.data = {}
+        self._records = 0
+        self._journal = None  # unbuffered, so nothing is left half-written in a buffer
+        self._journal_end = 0  # bytes up to the end of the last whole record
+        self._compactor = None
+
+    def load(self):
+        if os.path.exists(self.old_journal_path):
+            # the last compaction was interrupted: finish it now, before taking new writes
+            compact_segment(self.path, self.old_journal_path)
+        self.data, self.seq = read_snapshot(self.path, self.conversations)
+        records, end = read_journal(self.journal_path)
+        self.seq = replay(self.data, records, self.seq, self.conversations)
+        self._records = len(records)
+        if os.path.exists(self.journal_path) and end < os.path.getsize(self.journal_path):
+            # cut the torn tail so new records are not appended after garbage
+            os.truncate(self.journal_path, end)
+        self._journal_end = end
+        self._open_journal()
+        self.start()
+        return self.data
+
+    def chat(self, chat_id):
+        key = str(chat_id)
+        chat = self.data.get(key)
+        if chat is None:
+            chat = self.data[key] = Chat()
+        return chat
+
+    def loaded(self):
+        return self.data
+
+    def chats(self):
+        return list(self.data.items())
+
+    def close(self):
+        super().close()
+        if self._compactor is not None:
+            self._compactor.join()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _open_journal(self):
+        self._journal = open(self.journal_path, "ab", buffering=0)
+        # whatever a failed write left after the last whole record goes, so a retry starts on a clean line
+        self._journal.truncate(self._journal_end)
+
+    def _write(self, batch):
+        data = "".join(json.dumps({"seq": seq, "op": op}, ensure_ascii=False) + "\n" for seq, op in batch).encode("utf-8")
+        if self._journal is None:
+            self._open_journal()
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[self._journal.write(view):]
+            os.fsync(self._journal.fileno())
+        except OSError:
+            self._journal.close()
+            self._journal = None
+            raise
+        self._journal_end += len(data)
+        self._records += len(batch)
+        if self._records >= self.compact_every and not os.path.exists(self.old_journal_path):
+            # if this fails the batch is written again; replay skips seqs it has already seen
+            self._journal.close()
+            self._journal = None
+            os.replace(self.journal_path, self.old_journal_path)
+            self._journal_end = 0
+            self._open_journal()
+            self._records = 0
+            self._compactor = threading.Thread(
+                target=compact_segment, args=(self.path, self.old_journal_path), name="compactor"
+            )
+            self._compactor.start()
+        return len(data)
+
+# ---------------- SQLite ----------------
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    lang TEXT NOT NULL DEFAULT 'ua',
+    current TEXT
+);
+CREATE TABLE IF NOT EXISTS parties (
+    chat_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    creator INTEGER,
+    PRIMARY KEY (chat_id, name)
+);
+CREATE TABLE IF NOT EXISTS members (
+    chat_id TEXT NOT NULL,
+    party TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (chat_id, party, name)
+);
+CREATE TABLE IF NOT EXISTS expenses (
+    id INTEGER PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    party TEXT NOT NULL,
+    user TEXT NOT NULL,
+    cents INTEGER NOT NULL,
+    desc TEXT,
+    ts TEXT,
+    split TEXT
+);
+CREATE INDEX IF NOT EXISTS expenses_by_party ON expenses (chat_id, party, id);
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    amount INTEGER,
+    split TEXT,
+    at REAL NOT NULL
+);
+"""
+
+def connect(path, **kwargs):
+    conn = sqlite3.connect(path, **kwargs)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    if "split" not in {row[1] for row in conn.execute("PRAGMA table_info(expenses)")}:
+        # databases made before splits
+        conn.execute("ALTER TABLE expenses ADD COLUMN split TEXT")
+    return conn
+
+def sql_apply(conn, op):
+    """Mirror of apply_op (and apply_conversation) against the tables."""
+    kind = op["op"]
+    if kind == "conversation":
+        if op["state"] is None:
+            conn.execute("DELETE FROM conversations WHERE user_id = ?", (op["user"],))
+        else:
+            split = json.dumps(op["split"], ensure_ascii=False) if op["split"] else None
+            conn.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?)",
+                         (op["user"], op["state"], op["amount"], split, op["at"]))
+        return
+    c = op["chat"]
+    conn.execute("INSERT OR IGNORE INTO chats (chat_id) VALUES (?)", (c,))
+    if kind == "lang":
+        conn.execute("UPDATE chats SET lang = ? WHERE chat_id = ?", (op["lang"], c))
+    elif kind == "party_create":
+        conn.execute("INSERT OR IGNORE INTO parties VALUES (?, ?, ?)", (c, op["name"], op["creator"]))
+        conn.execute("INSERT OR IGNORE INTO members VALUES (?, ?, ?)", (c, op["name"], op["member"]))
+        conn.execute("UPDATE chats SET current = ? WHERE chat_id = ?", (op["name"], c))
+    elif kind == "select":
+        conn.execute("UPDATE chats SET current = ? WHERE chat_id = ?", (op["name"], c))
+    elif kind == "expense":
+        p = op["party"]
+        conn.execute("INSERT OR IGNORE INTO parties VALUES (?, ?, NULL)", (c, p))
+        conn.execute("INSERT OR IGNORE INTO members VALUES (?, ?, ?)", (c, p, op["user"]))
+        cents = op["cents"] if "cents" in op else to_cents(op["amount"])
+        split = json.dumps(op["split"], ensure_ascii=False) if op.get("split") else None
+        conn.execute(
+            "INSERT INTO expenses (chat_id, party, user, cents, desc, ts, split) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (c, p, op["user"], cents, op["desc"], op["ts"], split),
+        )
+    elif kind == "member_add":
+        conn.execute("INSERT OR IGNORE INTO parties VALUES (?, ?, NULL)", (c, op["party"]))
+        conn.execute("INSERT OR IGNORE INTO members VALUES (?, ?, ?)", (c, op["party"], op["name"]))
+    elif kind == "member_remove":
+        conn.execute("DELETE FROM members WHERE chat_id = ? AND party = ? AND name = ?", (c, op["party"], op["name"]))
+    elif kind == "party_delete":
+        for table, col in (("parties", "name"), ("members", "party"), ("expenses", "party")):
+            conn.execute(f"DELETE FROM {table} WHERE chat_id = ? AND {col} = ?", (c, op["name"]))
+        conn.execute("UPDATE chats SET current = NULL WHERE chat_id = ? AND current = ?", (c, op["name"]))
+    else:
+        raise ValueError(f"unknown op: {kind}")
+
+class SqliteStore(Storage):
+    """Chats live in SQLite and are loaded on first access.
+
+    At most ``cache_size`` chats are kept in memory; the least recently used
+    one is dropped when a new one is loaded, unless it still has queued writes.
+    """
+
+    def __init__(self, path, max_lag=1.0, cache_size=256):
+        super().__init__(max_lag)
+        self.path = path
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._conn = None  # reads, on the caller's thread
+        self._wconn = None  # writes, on the writer thread
+
+    def load(self):
+        self._conn = connect(self.path)
+        for user_id, state, amount, split, at in self._conn.execute("SELECT * FROM conversations"):
+            self.conversations[user_id] = Conversation(state, amount, json.loads(split) if split else None, at)
+        self.start()
+
+    def chat(self, chat_id):
+        key = str(chat_id)
+        chat = self._cache.get(key)
+        if chat is not None:
+            self._cache.move_to_end(key)
+            return chat
+        chat = self._cache[key] = self._read_chat(key)
+        if len(self._cache) > self.cache_size:
+            for old in list(self._cache)[:-1]:
+                if not self.is_dirty(old):
+                    del self._cache[old]
+                    break
+        return chat
+
+    def loaded(self):
+        return self._cache
+
+    def chats(self):
+        # one chat at a time, without filling the cache
+        for (key,) in self._conn.execute("SELECT chat_id FROM chats ORDER BY rowid").fetchall():
+            chat = self._cache.get(key)
+            yield key, chat if chat is not None else self._read_chat(key)
+
+    def _read_chat(self, key):
+        chat = Chat()
+        row = self._conn.execute("SELECT lang, current FROM chats WHERE chat_id = ?", (key,)).fetchone()
+        if row is None:
+            return chat
+        chat.lang, chat.current = row
+        parties = chat.parties
+        for name, creator in self._conn.execute(
+            "SELECT name, creator FROM parties WHERE chat_id = ? ORDER BY rowid", (key,)
+        ):
+            parties[name] = Party(creator, chat.rollup)
+        for party, name in self._conn.execute(
+            "SELECT party, name FROM members WHERE chat_id = ? ORDER BY rowid", (key,)
+        ):
+            parties[party].add_member(name)
+        for party, user, cents, desc, ts, split in self._conn.execute(
+            "SELECT party, user, cents, desc, ts, split FROM expenses WHERE chat_id = ? ORDER BY id", (key,)
+        ):
+            split = split_from_ops(json.loads(split)) if split else None
+            parties[party].add_expense(user, cents, desc, ts, join=False, split=split)
+        return chat
+
+    def close(self):
+        super().close()
+        for conn in (self._conn, self._wconn):
+            if conn is not None:
+                conn.close()
+        self._conn = self._wconn = None
+
+    def _write(self, batch):
+        if self._wconn is None:
+            self._wconn = connect(self.path, check_same_thread=False)
+        with self._wconn:
+            for _, op in batch:
+                sql_apply(self._wconn, op)
+
+def sql_split(split):
+    return json.dumps(split_to_ops(split), ensure_ascii=False) if split else None
+
+def sql_insert_chat(conn, chat_id, chat):
+    """Insert a whole chat; parties the database already has are kept as they are."""
+    conn.execute("INSERT OR IGNORE INTO chats VALUES (?, ?, ?)", (chat_id, chat.lang, chat.current))
+    conn.execute("UPDATE chats SET current = ? WHERE chat_id = ? AND current IS NULL", (chat.current, chat_id))
+    for name, p in chat.parties.items():
+        if conn.execute("SELECT 1 FROM parties WHERE chat_id = ? AND name = ?", (chat_id, name)).fetchone():
+            continue
+        conn.execute("INSERT INTO parties VALUES (?, ?, ?)", (chat_id, name, p.creator))
+        conn.executemany(
+            "INSERT INTO members VALUES (?, ?, ?)",
+            [(chat_id, name, m) for m in p.members],
+        )
+        ex = p.expenses
+        conn.executemany(
+            "INSERT INTO expenses (chat_id, party, user, cents, desc, ts, split) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(chat_id, name, ex.user(i), ex.cents[i], ex.desc(i), ex.ts(i), sql_split(ex.split(i)))
+             for i in range(len(ex))],
+        )
+
+def import_json(db_path, *json_paths):
+    """One-shot import of the legacy JSON files into an empty SQLite database.
+
+    Files are read in order; a chat's lang/current come from the first file
+    that has them and parties already imported are not overwritten.
+    """
+    conn = connect(db_path)
+    if conn.execute("SELECT 1 FROM chats LIMIT 1").fetchone():
+        conn.close()
+        raise RuntimeError(f"{db_path} already has data")
+    with conn:
+        for path in json_paths:
+            data, _ = read_snapshot(path)
+            for chat_id, chat in data.items():
+                sql_insert_chat(conn, chat_id, chat)
+    conn.close()
+
+if __name__ == "__main__":
+    # python storage.py data.db data.json parties_data.json
+    if len(sys.argv) < 3:
+        print("usage: python storage.py DB_FILE JSON_FILE [JSON_FILE ...]")
+        sys.exit(1)
+    import_json(sys.argv[1], *sys.argv[2:])
+    print(f"Imported {', '.join(sys.argv[2:])} into {sys.argv[1]}")
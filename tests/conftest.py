@@ -0,0 +1,31 @@
+import os
+import sys
+
+# the bot's modules sit at the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from storage import JsonStore, SqliteStore
+
+@pytest.fixture(params=["json", "sqlite"])
+def open_store(request, tmp_path):
+    """Opens (and loads) the store kept in ``tmp_path``, once per backend.
+
+    The JSON journal is compacted every 50 records and SQLite keeps two chats
+    in memory, so compaction and eviction both happen within a short test.
+    """
+    opened = []
+
+    def open_store():
+        if request.param == "json":
+            store = JsonStore(str(tmp_path / "data.json"), max_lag=0.01, compact_every=50)
+        else:
+            store = SqliteStore(str(tmp_path / "data.db"), max_lag=0.01, cache_size=2)
+        store.load()
+        opened.append(store)
+        return store
+
+    yield open_store
+    for store in opened:
+        store.close()
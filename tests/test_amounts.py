@@ -0,0 +1,26 @@
+import pytest
+
+from party import MAX_CENTS, parse_amount, parse_bill
+
+def test_parse_amount():
+    assert parse_amount("25.50") == 2550
+    assert parse_amount("25,5") == 2550
+    assert parse_amount("0.005") == 1
+    assert parse_amount(str(MAX_CENTS // 100)) == MAX_CENTS
+
+@pytest.mark.parametrize("text", ["", "abc", "-1", "nan", "inf", "1e30", "1e17", "1e999999", "10000000000000.01"])
+def test_parse_amount_rejects(text):
+    with pytest.raises(ValueError):
+        parse_amount(text)
+
+def test_parse_bill():
+    assert parse_bill("25.50") == (2550, None)
+    assert parse_bill("25.50 ann @bob:1,5") == (2550, [(2550, [("ann", 100), ("bob", 150)])])
+    assert parse_bill("10 ann\n5") == (1500, [(1000, [("ann", 100)]), (500, [])])
+
+@pytest.mark.parametrize("text", ["", "10 bob:inf", "10 bob:nan", "10 bob:1e999999", "10 bob:-1", "10 bob:0",
+                                  "10 bob:0.001", "10 bob:1e7", "10 bob:x", "10 :2", "1e17 ann",
+                                  "9000000000000 ann\n9000000000000 bob"])
+def test_parse_bill_rejects(text):
+    with pytest.raises(ValueError):
+        parse_bill(text)
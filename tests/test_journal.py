@@ -0,0 +1,65 @@
+import io
+import threading
+
+import storage
+from storage import JsonStore
+
+class TornFile(io.FileIO):
+    """A journal whose writes fail halfway through while ``fail`` is set."""
+    fail = False
+
+    def write(self, data):
+        if TornFile.fail:
+            super().write(bytes(data[:len(data) // 2]))
+            raise OSError(28, "No space left on device")
+        return super().write(data)
+
+def torn_open(path, mode, buffering=-1):
+    return TornFile(path, mode)
+
+def langs(path):
+    store = JsonStore(path)
+    store.load()
+    try:
+        return {chat_id: chat.lang for chat_id, chat in store.loaded().items()}
+    finally:
+        store.close()
+
+def test_torn_write_is_truncated_before_retry(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "open", torn_open, raising=False)
+    path = str(tmp_path / "data.json")
+    store = JsonStore(path, max_lag=0.01)
+    store.load()
+    store.commit({"op": "lang", "chat": "1", "lang": "en"})
+    store.flush()
+    TornFile.fail = True
+    store.commit({"op": "lang", "chat": "2", "lang": "ru"})
+    with store._cond:
+        while store._failures == 0:
+            store._cond.wait()
+    TornFile.fail = False
+    store.commit({"op": "lang", "chat": "3", "lang": "en"})
+    store.flush()
+    store.close()
+    monkeypatch.undo()
+    assert langs(path) == {"1": "en", "2": "ru", "3": "en"}
+
+def test_close_gives_up_when_writes_keep_failing(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "open", torn_open, raising=False)
+    path = str(tmp_path / "data.json")
+    store = JsonStore(path, max_lag=0.01)
+    store.load()
+    store.commit({"op": "lang", "chat": "1", "lang": "en"})
+    store.flush()
+    TornFile.fail = True
+    try:
+        store.commit({"op": "lang", "chat": "2", "lang": "ru"})
+        store.flush()
+        closer = threading.Thread(target=store.close)
+        closer.start()
+        closer.join(5)
+        assert not closer.is_alive()
+    finally:
+        TornFile.fail = False
+    monkeypatch.undo()
+    assert langs(path) == {"1": "en"}
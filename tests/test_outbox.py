@@ -0,0 +1,29 @@
+import asyncio
+from types import SimpleNamespace
+
+from outbox import Outbox
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None, message_thread_id=None):
+        self.sent.append((chat_id, message_thread_id, text))
+
+    async def send_document(self, chat_id, document, caption=None, reply_markup=None, message_thread_id=None):
+        self.sent.append((chat_id, message_thread_id, caption))
+
+def test_replies_keep_their_topic():
+    async def run():
+        bot = FakeBot()
+        outbox = Outbox(chat_rate=0, group_rate=0, global_rate=0)
+        await outbox.start(SimpleNamespace(bot=bot))
+        # queued without yielding, so they are all waiting when the chat's turn comes
+        outbox.send(-1, "a")
+        outbox.send(-1, "b", thread_id=7)
+        outbox.send(-1, "c", thread_id=7)
+        outbox.send(-1, "d")
+        await outbox.stop(timeout=5)
+        return bot.sent
+
+    assert asyncio.run(run()) == [(-1, None, "a"), (-1, 7, "b\n\nc"), (-1, None, "d")]
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import time
+from enum import Enum
+
+import pytest
+
+from persistence import AMOUNT, SPLIT, STATE, StorePersistence
+from storage import Conversation, JsonStore, SqliteStore
+
+class State(Enum):
+    MENU = "menu"
+    ENTERING_AMOUNT = "entering_amount"
+    ENTERING_DESCRIPTION = "entering_description"
+
+SPLIT_OPS = [{"cents": 1250, "weights": {"ann": 1, "bob": 1.5}}, {"cents": 700, "weights": {}}]
+
+def run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture
+def store(tmp_path):
+    store = JsonStore(str(tmp_path / "data.json"), max_lag=0.01)
+    store.load()
+    yield store
+    store.close()
+
+def test_only_changes_are_written(store):
+    persistence = StorePersistence(store, State)
+    run(persistence.update_user_data(7, {STATE: State.ENTERING_AMOUNT}))
+    assert store.seq == 1
+    run(persistence.update_user_data(7, {STATE: State.ENTERING_AMOUNT}))
+    assert store.seq == 1
+    data = {STATE: State.ENTERING_DESCRIPTION, AMOUNT: 1950, SPLIT: SPLIT_OPS}
+    run(persistence.update_user_data(7, data))
+    run(persistence.update_user_data(7, dict(data)))
+    assert store.seq == 2
+    assert store.conversations["7"][:3] == ("entering_description", 1950, SPLIT_OPS)
+    # back at the menu: one delete, then nothing
+    run(persistence.update_user_data(7, {STATE: State.MENU}))
+    run(persistence.update_user_data(7, {STATE: State.MENU}))
+    run(persistence.update_user_data(8, {}))
+    assert store.seq == 3
+    assert store.conversations == {}
+
+def test_expired_conversations_are_dropped(store):
+    persistence = StorePersistence(store, State, ttl=60)
+    now = time.time()
+    store.keep_conversation(1, Conversation("entering_amount", None, None, now))
+    store.keep_conversation(2, Conversation("entering_description", 500, SPLIT_OPS, now - 120))
+    store.keep_conversation(3, Conversation("no_such_step", None, None, now))
+    assert run(persistence.get_user_data()) == {1: {STATE: State.ENTERING_AMOUNT}}
+    assert list(store.conversations) == ["1"]
+
+    store.keep_conversation(1, Conversation("entering_description", 500, SPLIT_OPS, now - 120))
+    user_data = {STATE: State.ENTERING_DESCRIPTION, AMOUNT: 500, SPLIT: SPLIT_OPS, "other": 1}
+    run(persistence.refresh_user_data(1, user_data))
+    assert user_data == {"other": 1}
+    assert store.conversations == {}
+
+def reload(kind, tmp_path, **kw):
+    path = str(tmp_path / ("data.json" if kind == "json" else "data.db"))
+    store = JsonStore(path, max_lag=0.01, **kw) if kind == "json" else SqliteStore(path, max_lag=0.01)
+    store.load()
+    return store
+
+@pytest.mark.parametrize("kind, kw", [("json", {}), ("json", {"compact_every": 2}), ("sqlite", {})])
+def test_conversations_survive_a_reload(kind, kw, tmp_path):
+    kept = Conversation("entering_description", 1950, SPLIT_OPS, 1700000000.5)
+    store = reload(kind, tmp_path, **kw)
+    store.keep_conversation(5, Conversation("entering_amount", None, None, 1700000000.0))
+    store.keep_conversation(6, Conversation("entering_amount", None, None, 1700000000.0))
+    store.keep_conversation(5, kept)
+    store.keep_conversation(6, None)
+    store.flush()
+    store.close()
+    if kw:
+        # the journal was folded into the snapshot
+        with open(tmp_path / "data.json", encoding="utf-8") as f:
+            assert json.load(f)["_conversations"] == {"5": list(kept)}
+    store = reload(kind, tmp_path, **kw)
+    try:
+        assert store.conversations == {"5": kept}
+    finally:
+        store.close()
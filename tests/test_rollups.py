@@ -0,0 +1,53 @@
+import random
+from collections import defaultdict
+
+from party import month_of, to_cents, ts_to_micros
+
+CHATS = "01234"
+
+def brute(chat):
+    # (party, month, member) -> [cents, expenses], None meaning every party / all time / everybody
+    out = defaultdict(lambda: [0, 0])
+    for name, party in chat.parties.items():
+        for e in party.expenses:
+            month = month_of(ts_to_micros(e["ts"])) if e["ts"] else None
+            for p in (None, name):
+                for mo in {None, month}:
+                    for who in (None, e["user"]):
+                        cell = out[(p, mo, who)]
+                        cell[0] += to_cents(e["amount"])
+                        cell[1] += 1
+    return dict(out)
+
+def rollups(chat):
+    got = {}
+    for mo, row in chat.rollup.months.items():
+        got.update(((None, mo, who), list(cell)) for who, cell in row.items())
+    for name, party in chat.parties.items():
+        for mo, row in party.rollup.months.items():
+            got.update(((name, mo, who), list(cell)) for who, cell in row.items())
+    return got
+
+def test_rollups_match_expenses(open_store):
+    rng = random.Random(1)
+    store = open_store()
+    for _ in range(1500):
+        chat, party, r = rng.choice(CHATS), f"p{rng.randrange(4)}", rng.random()
+        if r < 0.05:
+            store.commit({"op": "party_delete", "chat": chat, "name": party})
+        elif r < 0.1:
+            store.commit({"op": "party_create", "chat": chat, "name": party, "creator": 1, "member": "a"})
+        else:
+            ts = None if rng.random() < 0.1 else f"2026-{rng.randrange(1, 13):02d}-{rng.randrange(1, 28):02d}T10:00:00"
+            store.commit({"op": "expense", "chat": chat, "party": party, "user": rng.choice("abcde"),
+                          "cents": rng.randrange(1, 9999), "desc": "", "ts": ts})
+        if rng.random() < 0.02:
+            c = store.chat(rng.choice(CHATS))
+            assert rollups(c) == brute(c)
+    for c in CHATS:
+        assert rollups(store.chat(c)) == brute(store.chat(c))
+    store.close()
+
+    store = open_store()
+    for c in CHATS:
+        assert rollups(store.chat(c)) == brute(store.chat(c))
@@ -0,0 +1,32 @@
+import json
+from io import StringIO
+
+import pytest
+
+from party import Chat
+from schema import iter_object, read_chats
+
+DOC = {"a": 1.5, "b": -12, "c": 3e-7, "d": 1.25E+3, "e": 0, "f": [1, 2.5, {"g": -0.5}],
+       "h": "x:1.5,", "i": True, "j": None, "k": {}, "l": 12345678901234567890, "m": -1e300}
+
+@pytest.mark.parametrize("chunk_size", range(1, 9))
+def test_iter_object_small_chunks(chunk_size):
+    assert dict(iter_object(StringIO('{"a": 1.5}'), chunk_size=chunk_size)) == {"a": 1.5}
+    assert dict(iter_object(StringIO('{"a":12,"b":3e10}'), chunk_size=chunk_size)) == {"a": 12, "b": 3e10}
+    for text in (json.dumps(DOC), json.dumps(DOC, indent=2), json.dumps(DOC, separators=(",", ":"))):
+        assert dict(iter_object(StringIO(text), chunk_size=chunk_size)) == json.loads(text)
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1 << 16])
+@pytest.mark.parametrize("text", ['{"a": 1.}', '{"a": 1', '{"a" 1}', '[1]', '{"a": 1,}'])
+def test_iter_object_rejects(text, chunk_size):
+    with pytest.raises(ValueError):
+        dict(iter_object(StringIO(text), chunk_size=chunk_size))
+
+def test_v1_expense_with_numeric_ts_and_desc(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_text(json.dumps({"1": {"parties": {"p": {"members": ["ann"], "expenses": [
+        {"user": "ann", "amount": 5, "desc": 42, "ts": 1700000000}]}}}}), encoding="utf-8")
+    (chat_id, raw), = read_chats(str(path))
+    assert raw["parties"]["p"]["expenses"] == [
+        {"user": "ann", "amount": 5.0, "desc": "42", "ts": "1700000000", "split": None}]
+    assert Chat.from_json(raw).to_json()["parties"]["p"]["expenses"] == raw["parties"]["p"]["expenses"]
@@ -0,0 +1,83 @@
+import random
+from functools import lru_cache
+from itertools import combinations
+
+import settlement
+from metrics import METRICS
+from settlement import min_transfers
+
+def fewest_transfers(values):
+    # n minus the most zero-sum groups, found by trying every group the first member can be in
+    @lru_cache(maxsize=None)
+    def most_groups(rest):
+        if not rest:
+            return 0
+        first, others = rest[0], rest[1:]
+        best = 0
+        for k in range(len(others) + 1):
+            for mates in combinations(others, k):
+                if values[first] + sum(values[i] for i in mates) == 0:
+                    left = tuple(i for i in others if i not in mates)
+                    best = max(best, 1 + most_groups(left))
+        return best
+    return len(values) - most_groups(tuple(range(len(values))))
+
+def balances(rng, n):
+    values = [rng.choice([-1, 1]) * rng.randrange(1, 8) for _ in range(n - 1)]
+    values.append(-sum(values))
+    if 0 in values:
+        return None
+    return tuple(sorted(values))
+
+def check_clears(values, debts):
+    left = list(values)
+    for d, c, cents in debts:
+        assert cents > 0 and values[d] < 0 < values[c]
+        left[d] += cents
+        left[c] -= cents
+    assert not any(left)
+
+def test_min_transfers_is_minimal():
+    rng = random.Random(3)
+    checked = 0
+    while checked < 500:
+        values = balances(rng, rng.randrange(2, 9))
+        if values is None:
+            continue
+        debts = min_transfers(values)
+        check_clears(values, debts)
+        assert len(debts) == fewest_transfers(values), values
+        checked += 1
+
+def test_opposite_pairs_settle_directly(monkeypatch):
+    values = (-7, -5, -3, 2, 5, 8)
+    debts = min_transfers(values)
+    check_clears(values, debts)
+    assert (1, 4, 5) in debts
+    assert len(debts) == fewest_transfers(values)
+    # even when the rest is paired greedily, which would split -5 across 8 and 5
+    min_transfers.cache_clear()
+    monkeypatch.setattr(settlement, "MAX_EXACT", 0)
+    debts = min_transfers(values)
+    check_clears(values, debts)
+    assert (1, 4, 5) in debts
+    min_transfers.cache_clear()
+
+def greedy_count(reason):
+    return METRICS.counters.get(("bot_settle_greedy_total", (("reason", reason),)), 0)
+
+def test_greedy_fallback(monkeypatch):
+    values = (-40, -31, -22, -13, -9, -4, 1, 3, 10, 20, 35, 50)
+    min_transfers.cache_clear()
+    monkeypatch.setattr(settlement, "MAX_EXACT", 5)
+    before = greedy_count("size")
+    check_clears(values, min_transfers(values))
+    assert greedy_count("size") == before + 1
+
+    min_transfers.cache_clear()
+    monkeypatch.setattr(settlement, "MAX_EXACT", 14)
+    monkeypatch.setattr(settlement, "TIME_BUDGET", -1.0)
+    before = greedy_count("time")
+    check_clears(values, min_transfers(values))
+    assert greedy_count("time") == before + 1
+    min_transfers.cache_clear()
@@ -0,0 +1,93 @@
+import random
+from fractions import Fraction
+from math import floor
+
+from party import split_to_ops, to_cents
+
+NAMES = "abcdefg"
+CHATS = "012"
+
+def exact_shares(party):
+    """Fair shares worked out from the expenses alone.
+
+    Only expenses paid by members count. Parts shared by the same members with
+    the same weights are added up first, and each total is cut in exact
+    fractions: whole cents first, then one more cent to each of the biggest
+    fractions (earlier names on ties). Parts nobody left in the party shares
+    join the even pool, which is cut the same way by member order.
+    """
+    members = list(party.members)
+    sets, pool = {}, 0
+    for e in party.expenses:
+        if e["user"] not in party.members:
+            continue
+        if not e["split"]:
+            pool += to_cents(e["amount"])
+            continue
+        for part in e["split"]:
+            who = tuple((u, round(Fraction(w) * 100)) for u, w in part["weights"].items() if u in party.members)
+            sets[who] = sets.get(who, 0) + to_cents(part["amount"])
+    pool += sets.pop((), 0)
+    shares = dict.fromkeys(members, 0)
+    for who, total in [(tuple((u, 1) for u in members), pool), *sets.items()]:
+        weight = sum(w for _, w in who)
+        exact = [Fraction(total * w, weight) for _, w in who]
+        cut = [floor(x) for x in exact]
+        order = sorted(range(len(who)), key=lambda i: cut[i] - exact[i])
+        for i in order[:total - sum(cut)]:
+            cut[i] += 1
+        for (u, _), c in zip(who, cut):
+            shares[u] += c
+    return shares
+
+def check(chat):
+    for party in chat.parties.values():
+        shares = party.shares()
+        assert shares == exact_shares(party)
+        if not party.members:
+            continue
+        _, balances, debts = party.settlements()
+        assert balances == {u: p - shares[u] for u, p in party.members.items()}
+        assert sum(balances.values()) == 0
+        left = dict(balances)
+        for debtor, creditor, cents in debts:
+            assert cents > 0
+            left[debtor] += cents
+            left[creditor] -= cents
+        assert not any(left.values())
+
+def test_shares_match_exact_fractions(open_store):
+    rng = random.Random(2)
+    store = open_store()
+    for i in range(2500):
+        chat, party, r = rng.choice(CHATS), f"p{rng.randrange(3)}", rng.random()
+        if r < 0.06:
+            store.commit({"op": "member_remove", "chat": chat, "party": party, "name": rng.choice(NAMES)})
+        elif r < 0.13:
+            # most of these bring back someone removed earlier
+            store.commit({"op": "member_add", "chat": chat, "party": party, "name": rng.choice(NAMES)})
+        elif r < 0.14:
+            store.commit({"op": "party_delete", "chat": chat, "name": party})
+        else:
+            op = {"op": "expense", "chat": chat, "party": party, "user": rng.choice(NAMES), "desc": "", "ts": None}
+            if rng.random() < 0.5:
+                parts = []
+                for _ in range(rng.choice([1, 1, 2, 3])):
+                    who = [(u, rng.choice([100, 100, 200, 150, 33])) for u in rng.sample(NAMES, rng.randrange(0, 4))]
+                    parts.append((rng.randrange(1, 9999), who))
+                op["cents"] = sum(c for c, _ in parts)
+                op["split"] = split_to_ops(parts)
+            else:
+                op["cents"] = rng.randrange(1, 9999)
+            store.commit(op)
+        if i % 50 == 0:
+            check(store.chat(chat))
+    for c in CHATS:
+        check(store.chat(c))
+    before = {c: {n: p.shares() for n, p in store.chat(c).parties.items()} for c in CHATS}
+    store.close()
+
+    store = open_store()
+    for c in CHATS:
+        check(store.chat(c))
+        assert {n: p.shares() for n, p in store.chat(c).parties.items()} == before[c]
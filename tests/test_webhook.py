@@ -0,0 +1,35 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from telegram import Update
+
+from webhook import WebhookServer
+
+def route(body):
+    tasks = []
+
+    def create_task(coro, update=None):
+        coro.close()
+        tasks.append(update)
+
+    app = SimpleNamespace(bot=None, running=True, create_task=create_task)
+
+    async def run():
+        server = WebhookServer(app, "127.0.0.1", 0, "/telegram")
+        status, _ = await server._route("POST", "/telegram", {}, body)
+        return status, server.pending
+
+    status, pending = asyncio.run(run())
+    return status, pending, tasks
+
+def test_update_is_accepted():
+    status, pending, tasks = route(json.dumps({"update_id": 1}).encode())
+    assert (status, pending) == (200, 1)
+    assert isinstance(tasks[0], Update) and tasks[0].update_id == 1
+
+@pytest.mark.parametrize("body", [b"", b"{", b"[1]", b"5", b'"x"', b"null", b"{}", b'{"update_id": 1, "message": [1]}'])
+def test_not_an_update_is_rejected(body):
+    assert route(body) == (400, 0, [])
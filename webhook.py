@@ -0,0 +1,179 @@
+# webhook.py
+import ssl
+import signal
+import json
+import hmac
+import asyncio
+
+from telegram import Update
+
+from metrics import METRICS
+
+# Telegram only ever sends one JSON update per request
+MAX_BODY = 1024 * 1024
+STATUS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+          411: "Length Required", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+class WebhookServer:
+    """Receives updates over HTTP and feeds them to a running Application.
+
+    Small asyncio HTTP/1.1 server (no extra dependencies) with two routes:
+    POST ``path`` takes an update, GET ``health_path`` reports status.
+
+    Updates go straight to the application's update processor, so
+    CONCURRENT_UPDATES still caps how many run at once. ``limit`` caps how many
+    are accepted but not yet handled. When that many are pending, a POST waits
+    up to ``wait`` seconds for room and then gets 503. Telegram redelivers
+    rejected updates later, so a slow bot pushes back instead of queueing
+    without bound.
+    """
+
+    def __init__(self, app, listen, port, path, secret=None, health_path="/healthz",
+                 limit=1000, wait=5.0, cert=None, key=None):
+        self.app = app
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.health_path = health_path
+        self.limit = limit
+        self.wait = wait
+        self.pending = 0
+        self._slots = asyncio.Semaphore(limit)
+        self._ssl = None
+        if cert:
+            self._ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self._ssl.load_cert_chain(cert, key)
+        self._server = None
+        self._conns = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.listen, self.port, ssl=self._ssl)
+        # port 0 picks a free one
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            # idle keep-alive connections would hold wait_closed() open
+            for writer in list(self._conns):
+                writer.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self._conns.add(writer)
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                request_line, *lines = head.decode("latin-1").split("\r\n")
+                method, target, version = request_line.split(" ", 2)
+                headers = {}
+                for line in lines:
+                    name, sep, value = line.partition(":")
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                keep = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                if "chunked" in headers.get("transfer-encoding", "").lower():
+                    status, body = 411, {"ok": False}
+                    keep = False
+                elif int(headers.get("content-length") or 0) > MAX_BODY:
+                    status, body = 413, {"ok": False}
+                    keep = False
+                else:
+                    length = int(headers.get("content-length") or 0)
+                    data = await reader.readexactly(length) if length else b""
+                    status, body = await self._route(method, target.split("?", 1)[0], headers, data)
+                self._respond(writer, status, body, keep)
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._conns.discard(writer)
+            writer.close()
+
+    def _respond(self, writer, status, body, keep):
+        payload = json.dumps(body).encode("utf-8")
+        head = [
+            f"HTTP/1.1 {status} {STATUS[status]}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(payload)}",
+            "Connection: " + ("keep-alive" if keep else "close"),
+        ]
+        if status == 503:
+            head.append(f"Retry-After: {max(1, round(self.wait))}")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+
+    async def _route(self, method, path, headers, data):
+        if path == self.health_path:
+            if method != "GET":
+                return 405, {"ok": False}
+            ok = self.app.running
+            return (200 if ok else 503), {"ok": ok, "pending": self.pending, "limit": self.limit}
+        if path != self.path:
+            return 404, {"ok": False}
+        if method != "POST":
+            return 405, {"ok": False}
+        if self.secret and not hmac.compare_digest(
+                headers.get("x-telegram-bot-api-secret-token", ""), self.secret):
+            METRICS.inc("bot_webhook_rejected_total", reason="secret")
+            return 403, {"ok": False}
+        try:
+            payload = json.loads(data)
+            # valid JSON is not enough: [1] or null is no update, and {} decodes to None
+            update = Update.de_json(payload, self.app.bot) if isinstance(payload, dict) else None
+        except (ValueError, TypeError, KeyError, AttributeError):
+            update = None
+        if not isinstance(update, Update):
+            METRICS.inc("bot_webhook_rejected_total", reason="invalid")
+            return 400, {"ok": False}
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.wait)
+        except asyncio.TimeoutError:
+            METRICS.inc("bot_webhook_rejected_total", reason="busy")
+            return 503, {"ok": False}
+        self.pending += 1
+        METRICS.inc("bot_webhook_updates_total")
+        self.app.create_task(self._process(update), update=update)
+        return 200, {"ok": True}
+
+    async def _process(self, update):
+        try:
+            await self.app.update_processor.process_update(update, self.app.process_update(update))
+        finally:
+            self.pending -= 1
+            self._slots.release()
+
+async def run_webhook(app, server, url, max_connections=40):
+    """Start the application and the server, register the webhook and serve
+    until SIGINT/SIGTERM; updates already accepted are finished first."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: Ctrl+C still raises KeyboardInterrupt
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await server.start()
+    try:
+        await app.bot.set_webhook(url, secret_token=server.secret, max_connections=max_connections,
+                                  allowed_updates=Update.ALL_TYPES)
+        await app.start()
+        print(f"Webhook listening on {server.listen}:{server.port}{server.path}")
+        await stop.wait()
+    finally:
+        await server.stop()
+        if app.running:
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)